@@ -1,84 +1,376 @@
 import arrow
+import datetime
 import dialogflow
+import functools
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from google.api_core import grpc_helpers
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
 
 import consts
+from db import database
+from nlu import (
+    IntentResult,
+    LocalBackend,
+    NLUBackend,
+    RecordingBackend,
+    ReplayBackend,
+    intent_cache,
+    nlu_executor,
+    phrase_classifier,
+)
+
+load_dotenv()
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PROJECT_ID = "dojochatbot-gcietn"
+DEFAULT_KEYFILE = "keyfile.json"
+DIALOGFLOW_ADDRESS = "dialogflow.googleapis.com:443"
+DIALOGFLOW_SCOPES = (
+    "https://www.googleapis.com/auth/cloud-platform",
+    "https://www.googleapis.com/auth/dialogflow",
+)
+
+AUDIO_ENCODINGS = {
+    "LINEAR16": dialogflow.enums.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
+    "OGG_OPUS": dialogflow.enums.AudioEncoding.AUDIO_ENCODING_OGG_OPUS,
+}
+
+# Keep the channel warm between messages so requests don't pay for reconnecting
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+UNAVAILABLE_TEXT = (
+    "Sorry, I'm having trouble understanding you at the moment, "
+    "please try again shortly."
+)
+
+
+class SessionsClientManager:
+    """Manage a long-lived Dialogflow sessions client
+
+    The client and its gRPC channel are created once and shared across threads,
+    the credentials are refreshed in the background before they expire so no
+    request has to wait for a token refresh.
+    """
+
+    # Refresh the credentials this long before they expire
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+    RETRY_INTERVAL = 30
+
+    def __init__(self, keyfile):
+        """
+        Args:
+            keyfile (str): the path to the service account key file
+        """
+        self.keyfile = keyfile
+        self.num_clients_created = 0
+        self.num_requests = 0
+        self.num_refreshes = 0
+        self._client = None
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+
+    def get_client(self):
+        """Get the shared sessions client, creating it on first use
+
+        Returns:
+            SessionsClient: the Dialogflow sessions client
+        """
+        with self._lock:
+            if self._client is None:
+                # Scoped credentials are used as is by the channel, which lets
+                # the background thread refresh them in place
+                credentials = service_account.Credentials.from_service_account_file(
+                    self.keyfile, scopes=DIALOGFLOW_SCOPES
+                )
+                credentials.refresh(Request())
+                channel = grpc_helpers.create_channel(
+                    DIALOGFLOW_ADDRESS, credentials=credentials, options=CHANNEL_OPTIONS
+                )
+                self._credentials = credentials
+                self._client = dialogflow.SessionsClient(channel=channel)
+                self.num_clients_created += 1
+                self._start_refresh_thread()
+
+            self.num_requests += 1
+
+            return self._client
+
+    def stats(self):
+        """Get the connection reuse statistics
+
+        Returns:
+            dict: the statistics
+        """
+        with self._lock:
+            return {
+                "clients_created": self.num_clients_created,
+                "requests": self.num_requests,
+                "reused": self.num_requests - self.num_clients_created,
+                "credential_refreshes": self.num_refreshes,
+            }
+
+    def close(self):
+        """Stop refreshing the credentials and close the channel"""
+        self._stop_event.set()
+        with self._lock:
+            if self._client is not None:
+                self._client.transport.channel.close()
+                self._client = None
+
+    def _start_refresh_thread(self):
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_credentials,
+                name="DialogflowCredentials",
+                daemon=True,
+            )
+            self._refresh_thread.start()
+
+    def _refresh_credentials(self):
+        delay = self.RETRY_INTERVAL
+        while not self._stop_event.wait(delay):
+            delay = self.RETRY_INTERVAL
+            expiry = self._credentials.expiry
+            if expiry is not None:
+                refresh_at = expiry - self.REFRESH_MARGIN
+                if refresh_at > datetime.datetime.utcnow():
+                    delay = (refresh_at - datetime.datetime.utcnow()).total_seconds()
+                    continue
+
+            try:
+                self._credentials.refresh(Request())
+                with self._lock:
+                    self.num_refreshes += 1
+            except Exception:
+                LOGGER.exception("Failed to refresh Dialogflow credentials")
+
+
+class DialogflowBackend(NLUBackend):
+    """NLU backend that detects intents with a Dialogflow agent"""
+
+    def __init__(self, project_id, keyfile):
+        """
+        Args:
+            project_id (str): the Google Cloud project ID of the agent
+            keyfile (str): the path to the service account key file
+        """
+        self.project_id = project_id
+        self.session_clients = SessionsClientManager(keyfile)
+
+    def get_intent(
+        self,
+        session_id,
+        text=None,
+        input_audio=None,
+        audio_encoding="LINEAR16",
+        sample_rate=None,
+        timeout=None,
+    ):
+        if text is None and input_audio is None:
+            raise ValueError("Either text or input_audio must be provided")
+
+        language_code = "en"
+        session_client = self.session_clients.get_client()
+        session = session_client.session_path(self.project_id, session_id)
+
+        if text is not None:
+            text_input = dialogflow.types.TextInput(
+                text=text, language_code=language_code
+            )
+            query_input = dialogflow.types.QueryInput(text=text_input)
+        else:
+            audio_config = dialogflow.types.InputAudioConfig(
+                audio_encoding=AUDIO_ENCODINGS[audio_encoding],
+                sample_rate_hertz=sample_rate,
+                language_code=language_code,
+            )
+            query_input = dialogflow.types.QueryInput(audio_config=audio_config)
+
+        response = session_client.detect_intent(
+            session=session,
+            query_input=query_input,
+            input_audio=input_audio,
+            timeout=timeout,
+        )
+        query_result = response.query_result
+        intent = query_result.intent.display_name
+        params = None
+        all_params_present = True
+
+        if intent == consts.SCHEDULE_MEETING:
+            params = get_schedule_meeting_params(query_result.parameters)
+        elif intent in {
+            consts.STORE_AGENDA,
+            consts.GET_AGENDA,
+            consts.STORE_NOTES,
+            consts.GET_NOTES,
+            consts.CHANGE_REMIND,
+            consts.CANCEL_MEETING,
+            consts.DATE_INTENT,
+        }:
+            params = {"datetime": get_datetime(query_result.parameters)}
+
+        if params is not None:
+            all_params_present = check_params_present(params)
+
+        is_mentioned = query_result.query_text.lower().startswith(
+            f"hey {consts.BOT_NAME.lower()}"
+        )
+        result = IntentResult(
+            intent,
+            params,
+            all_params_present,
+            query_result.fulfillment_text,
+            is_mentioned,
+            query_result.query_text,
+        )
+
+        return result
+
+    def close(self):
+        self.session_clients.close()
+
 
+def create_nlu_backend():
+    """Create the NLU backend selected by NLU_BACKEND
 
-class IntentResult:
-    def __init__(self, intent, params, all_params_present, fulfill_text, is_mentioned):
-        self.intent = intent
-        self.params = params
-        self.all_params_present = all_params_present
-        self.fulfill_text = fulfill_text
-        self.is_mentioned = is_mentioned
+    "dialogflow" uses the agent of DIALOGFLOW_PROJECT_ID with the credentials
+    in DIALOGFLOW_KEYFILE, its responses are recorded to NLU_RECORD_FILE if set.
+    "local" uses the rule based backend and "replay" serves the responses in
+    NLU_REPLAY_FILE, each taking NLU_REPLAY_LATENCY seconds.
 
+    Returns:
+        NLUBackend: the NLU backend
+    """
+    name = os.getenv("NLU_BACKEND", "dialogflow")
+    if name == "local":
+        return LocalBackend()
+
+    if name == "replay":
+        return ReplayBackend(
+            os.getenv("NLU_REPLAY_FILE", "nlu_responses.jsonl"),
+            latency=float(os.getenv("NLU_REPLAY_LATENCY", 0)),
+        )
+
+    if name != "dialogflow":
+        raise ValueError(f"Unknown NLU backend: {name}")
+
+    backend = DialogflowBackend(
+        os.getenv("DIALOGFLOW_PROJECT_ID", DEFAULT_PROJECT_ID),
+        os.getenv("DIALOGFLOW_KEYFILE", DEFAULT_KEYFILE),
+    )
+    if os.getenv("NLU_RECORD_FILE"):
+        backend = RecordingBackend(backend, os.getenv("NLU_RECORD_FILE"))
+
+    return backend
+
+
+nlu_backend = create_nlu_backend()
 
-def get_intent(session_id, text=None, input_audio=None) -> IntentResult:
-    """Get intent from a given text
+
+def get_intent_or_fallback(session_id, text=None, user_data=None, **kwargs):
+    """Get intent through the NLU executor, which enforces a deadline and retries
+    transient errors. The local phrase classifier or a canned reply is used when
+    Dialogflow is slow or unavailable. Context free text intents are served from
+    the intent cache.
 
     Args:
         session_id (str): the session ID allows continuation of a conversation
-        text (str): the text for getting its intent
+        text (str, optional): the text for getting its intent. Defaults to None.
+        user_data (dict, optional): the Telegram user data. Defaults to None.
+        **kwargs: the audio arguments of get_intent
 
     Returns:
-        dict: the text intent along with some other information
-            {
-                "intent": str,
-                "params": dict(key=param_key, value=param_value),
-                "all_params_present": bool,
-                "fulfill_text": str
-            }
+        IntentResult: the intent result
     """
-    if text is None and input_audio is None:
-        raise ValueError("Either text or input_audio must be provided")
+    if text is not None:
+        intent = intent_cache.get(text)
+        if intent is not None:
+            return intent
 
-    project_id = "dojochatbot-gcietn"
-    language_code = "en"
-    session_client = dialogflow.SessionsClient.from_service_account_file("keyfile.json")
-    session = session_client.session_path(project_id, session_id)
+    # Don't hold the database write lock while waiting on Dialogflow
+    database.checkpoint()
+    start = time.monotonic()
+    intent = nlu_executor.call(
+        get_intent,
+        session_id,
+        text,
+        fallback=functools.partial(get_fallback_intent, text, user_data),
+        **kwargs,
+    )
 
     if text is not None:
-        text_input = dialogflow.types.TextInput(text=text, language_code=language_code)
-        query_input = dialogflow.types.QueryInput(text=text_input)
-    else:
-        audio_encoding = dialogflow.enums.AudioEncoding.AUDIO_ENCODING_LINEAR_16
-        audio_config = dialogflow.types.InputAudioConfig(
-            audio_encoding=audio_encoding, language_code=language_code,
-        )
-        query_input = dialogflow.types.QueryInput(audio_config=audio_config)
+        intent_cache.add(text, intent, time.monotonic() - start)
 
-    response = session_client.detect_intent(
-        session=session, query_input=query_input, input_audio=input_audio
-    )
-    query_result = response.query_result
-    intent = query_result.intent.display_name
-    params = None
-    all_params_present = True
-
-    if intent == consts.SCHEDULE_MEETING:
-        params = get_schedule_meeting_params(query_result.parameters)
-    elif intent in {
-        consts.STORE_AGENDA,
-        consts.GET_AGENDA,
-        consts.STORE_NOTES,
-        consts.GET_NOTES,
-        consts.CHANGE_REMIND,
-        consts.CANCEL_MEETING,
-        consts.DATE_INTENT,
-    }:
-        params = {"datetime": get_datetime(query_result.parameters)}
-
-    if params is not None:
-        all_params_present = check_params_present(params)
-
-    is_mentioned = query_result.query_text.lower().startswith(
-        f"hey {consts.BOT_NAME.lower()}"
-    )
-    result = IntentResult(
-        intent, params, all_params_present, query_result.fulfillment_text, is_mentioned
-    )
+    return intent
 
-    return result
+
+def get_fallback_intent(text=None, user_data=None):
+    """Get intent without calling Dialogflow
+
+    Args:
+        text (str, optional): the text for getting its intent. Defaults to None.
+        user_data (dict, optional): the Telegram user data. Defaults to None.
+
+    Returns:
+        IntentResult: the intent from the local phrase classifier, or a reply
+            asking the user to try again
+    """
+    intent = None
+    if text is not None:
+        intent = phrase_classifier.classify(text, user_data)
+
+    if intent is None:
+        intent = IntentResult(None, None, True, UNAVAILABLE_TEXT, False)
+
+    return intent
+
+
+def get_intent(
+    session_id,
+    text=None,
+    input_audio=None,
+    audio_encoding="LINEAR16",
+    sample_rate=None,
+    timeout=None,
+) -> IntentResult:
+    """Get intent from a given text or audio with the configured NLU backend
+
+    Args:
+        session_id (str): the session ID allows continuation of a conversation
+        text (str): the text for getting its intent
+        input_audio (bytes): the audio for getting its intent
+        audio_encoding (str): the audio encoding, LINEAR16 or OGG_OPUS
+        sample_rate (int): the audio sample rate, required for raw audio
+        timeout (float): the request timeout in seconds
+
+    Returns:
+        IntentResult: the intent result
+    """
+    return nlu_backend.get_intent(
+        session_id,
+        text=text,
+        input_audio=input_audio,
+        audio_encoding=audio_encoding,
+        sample_rate=sample_rate,
+        timeout=timeout,
+    )
 
 
 def get_schedule_meeting_params(params):
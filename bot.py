@@ -1,10 +1,12 @@
 import argparse
 import arrow
-import ffmpeg
+import functools
 import logging
 import os
-import re
-import tempfile
+import secrets
+import socket
+import urllib.parse
+import uuid
 
 from dotenv import load_dotenv
 from telegram import (
@@ -15,8 +17,8 @@ from telegram import (
     Chat,
     ForceReply,
 )
+from telegram.error import BadRequest, ChatMigrated, TelegramError, Unauthorized
 from telegram.ext import (
-    Updater,
     CommandHandler,
     MessageHandler,
     Filters,
@@ -27,11 +29,30 @@ from telegram.ext import (
 import consts
 import dojobot
 from db import database
-from api_service import get_intent
+from api_service import get_intent_or_fallback, nlu_backend
+from dispatcher import create_updater
+from message_filters import AddressedFilter, strip_mention
+from nlu import intent_cache, nlu_executor, parse_date, phrase_classifier
+from scheduler import NotificationScheduler
+from sharding import ShardConfig
+from voice import VoiceResult, VoiceStats, VoiceWorkerPool, recognise_voice, voice_cache
+from webhook import WebhookServer
 
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+# Voice messages are recognised in separate worker processes
+voice_workers = VoiceWorkerPool(
+    workers=int(os.getenv("VOICE_WORKERS", 2)),
+    max_pending=int(os.getenv("VOICE_QUEUE_SIZE", 16)),
+)
+voice_stats = VoiceStats()
+
+# Notifications are claimed by this process for the lease before sending them
+NOTI_SENDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+NOTI_LEASE_SECONDS = int(os.getenv("NOTI_LEASE_SECONDS", 60))
+NOTI_MAX_ATTEMPTS = int(os.getenv("NOTI_MAX_ATTEMPTS", 5))
+
 
 # Enable logging
 logging.basicConfig(
@@ -45,13 +66,53 @@ def init_db():
     print("Database has been initialised")
 
 
+def upgrade_db():
+    database.upgrade_schema()
+    print("Database has been upgraded")
+
+
 def main():
+    shard = ShardConfig(
+        int(os.getenv("SHARD_INDEX", 0)), int(os.getenv("SHARD_COUNT", 1))
+    )
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if shard.is_sharded and (not webhook_url or not os.getenv("WEBHOOK_SECRET")):
+        raise SystemExit("Shards need WEBHOOK_URL and the WEBHOOK_SECRET of the router")
+
     # Create the Updater and pass it your bot's token.
-    updater = Updater(TOKEN, use_context=True)
+    updater = create_updater(
+        TOKEN,
+        chat_workers=int(os.getenv("CHAT_WORKERS", 8)),
+        queue_size=int(os.getenv("UPDATE_QUEUE_SIZE", 1000)),
+        base_url=os.getenv("TELEGRAM_API_URL") or None,
+        base_file_url=os.getenv("TELEGRAM_FILE_URL") or None,
+        shard=shard,
+    )
+    database.upgrade_schema()
+    with database.unit_of_work():
+        database.delete_voice_recognitions(
+            arrow.utcnow().shift(seconds=-voice_cache.ttl)
+        )
+        database.delete_callback_tokens(
+            arrow.utcnow().shift(seconds=-dojobot.callback_tokens.ttl)
+        )
 
-    # Configure notifications job
-    job_queue = updater.job_queue
-    job_queue.run_repeating(send_notis, interval=10, first=0)
+    # Configure notifications scheduler
+    # Each shard only sends the notifications of its own chats
+    scheduler = NotificationScheduler(
+        functools.partial(send_notis, updater.bot), chat_filter=shard.owns
+    )
+    database.add_noti_listener(scheduler)
+    with database.unit_of_work():
+        scheduler.load(database.get_pending_notis())
+
+    scheduler.start()
+    updater.job_queue.run_repeating(
+        reclaim_notis,
+        int(os.getenv("NOTI_RECLAIM_INTERVAL", 60)),
+        first=NOTI_LEASE_SECONDS,
+        context=shard,
+    )
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -64,114 +125,59 @@ def main():
 
     dp.add_handler(MessageHandler(Filters.status_update.new_chat_members, greet_group))
     dp.add_handler(MessageHandler(Filters.voice, handle_audio))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text_msg))
-    dp.add_handler(MessageHandler(Filters.document, store_document))
 
-    # Change meeting reminder callback query handlers
+    # Unaddressed group messages are dropped before any handler is called
+    addressed = AddressedFilter(updater.bot.username, updater.bot.id)
     dp.add_handler(
-        CallbackQueryHandler(dojobot.remind_main_menu, pattern="remind_main")
-    )
-    dp.add_handler(CallbackQueryHandler(dojobot.remind_first_menu, pattern=r"rf.*"))
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.change_remind, pattern=rf"{consts.CHANGE_REMIND}.*"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.cancel_del, pattern="cancel_change_reminder")
+        MessageHandler(Filters.text & ~Filters.command & addressed, handle_text_msg)
     )
+    dp.add_handler(MessageHandler(Filters.document & addressed, store_document))
 
-    # Cancel meeting callback query handlers
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.cancel_meeting_main_menu, pattern="cancel_meeting_main"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.cancel_meeting_first_menu, pattern=r"cf.*")
-    )
-    dp.add_handler(CallbackQueryHandler(dojobot.cancel_meeting, pattern=r"cm.*"))
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.cancel_del, pattern="cancel_cancel_meeting")
-    )
+    # Button presses are routed to their dojobot handler by callback opcode
+    dp.add_handler(CallbackQueryHandler(dojobot.callback_router.handle))
 
-    # Meeting agenda callback query handlers
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.store_agenda_callback, pattern=rf"{consts.STORE_AGENDA}.*"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.get_agenda_callback, pattern=rf"{consts.GET_AGENDA}.*"
-        )
-    )
-
-    # Meeting notes callback query handlers
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.store_notes_callback, pattern=rf"{consts.STORE_NOTES}.*"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.get_notes_callback, pattern=rf"{consts.GET_NOTES}.*"
-        )
-    )
-
-    # Task callback query handlers
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.ask_task_name, pattern=consts.EDIT_TASK_NAME)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.ask_task_summary, pattern=consts.EDIT_TASK_SUMMARY)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.ask_task_user, pattern=consts.EDIT_TASK_USER)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.task_user_callback, pattern=rf"{consts.SET_TASK_USER}.*"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.ask_task_status, pattern=consts.EDIT_TASK_STATUS)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.task_status_callback, pattern=rf"{consts.SET_TASK_STATUS}.*"
-        )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.ask_task_date, pattern=consts.EDIT_TASK_DATE)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(dojobot.create_task, pattern=consts.CREATE_TASK_DONE)
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.cancel_create_task, pattern=consts.CANCEL_CREATE_TASK
+    # Start the Bot
+    webhook_server = None
+    if webhook_url:
+        webhook_server = WebhookServer(
+            updater.update_queue,
+            updater.bot,
+            os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+            listen=os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+            port=int(os.getenv("WEBHOOK_PORT", 8443)),
+            path=urllib.parse.urlparse(webhook_url).path,
         )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.update_task_callback, pattern=rf"{consts.UPDATE_TASK}.*"
+        # Shards receive their updates from the shard router
+        updater.start_webhook_server(
+            webhook_server, webhook_url, register=not shard.is_sharded
         )
-    )
-    dp.add_handler(
-        CallbackQueryHandler(
-            dojobot.task_feedback_callback, pattern=rf"{consts.TASK_FEEDBACK}.*"
+        LOGGER.info(
+            "Bot %r started webhook server on port %d", shard, webhook_server.port
         )
-    )
-
-    # Start the Bot
-    updater.start_polling()
-    LOGGER.info("Bot started polling")
+    else:
+        updater.start_polling()
+        LOGGER.info("Bot started polling")
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # starting the updater is non-blocking and will stop the bot gracefully.
     updater.idle()
+    scheduler.stop()
+    voice_workers.shutdown()
+    dp.chat_workers.shutdown()
+    LOGGER.info("Chat worker stats: %s", dp.chat_workers.stats())
+    if webhook_server is not None:
+        LOGGER.info("Webhook stats: %s", webhook_server.stats())
+
+    LOGGER.info("Addressed filter stats: %s", addressed.stats())
+    LOGGER.info("Voice stats: %s", voice_stats.stats())
+    LOGGER.info("Voice cache stats: %s", voice_cache.stats())
+    nlu_executor.shutdown()
+    nlu_backend.close()
+    LOGGER.info("Phrase classifier stats: %s", phrase_classifier.stats())
+    LOGGER.info("NLU executor stats: %s", nlu_executor.stats())
+    LOGGER.info("Intent cache stats: %s", intent_cache.stats())
+    LOGGER.info("Intent handler stats: %s", dojobot.intent_registry.stats())
 
 
 def start_msg(update, context):
@@ -297,14 +303,19 @@ def handle_text_msg(update, context):
         context (Context): the Telegram context object
     """
     message = update.effective_message
-    if not should_respond_message(context, message):
-        return
-
     message.chat.send_action(ChatAction.TYPING)
     if not handle_task_fields(context, message):
-        text = re.sub(rf"@{context.bot.username}\s*", "", message.text)
-        intent = get_intent(message.from_user.id, text)
-        handle_intent(update, context, message, intent)
+        text = strip_mention(message.text, context.bot.username)
+        intent = phrase_classifier.resolve(
+            text,
+            context.user_data,
+            functools.partial(
+                get_intent_or_fallback,
+                message.from_user.id,
+                user_data=context.user_data,
+            ),
+        )
+        handle_intent(update, context, intent)
 
 
 def handle_task_fields(context, message):
@@ -321,7 +332,7 @@ def handle_task_fields(context, message):
     user_data = context.user_data
     chat_id = message.chat.id
     task = user_data.get(consts.CURR_TASK)
-    text = re.sub(rf"@{context.bot.username}\s*", "", message.text)
+    text = strip_mention(message.text, context.bot.username)
 
     if task is not None:
         # Set task name
@@ -341,17 +352,19 @@ def handle_task_fields(context, message):
         # Set task due date
         elif user_data.get(consts.EDIT_TASK_DATE):
             is_success = True
-            intent = get_intent(message.chat.id, text)
             reply_markup = None
 
             if message.chat.type != Chat.PRIVATE:
                 reply_markup = ForceReply()
 
-            if (
-                intent.intent == consts.DATE_INTENT
-                and intent.params["datetime"] is not None
-            ):
-                due_date = intent.params["datetime"]
+            # Only ask Dialogflow for dates that can't be parsed locally
+            due_date = parse_date(text)
+            if due_date is None:
+                intent = get_intent_or_fallback(message.chat.id, text)
+                if intent.intent == consts.DATE_INTENT:
+                    due_date = intent.params["datetime"]
+
+            if due_date is not None:
                 if due_date >= arrow.utcnow().floor("day").shift(days=1):
                     task.due_date = due_date
                     del user_data[consts.EDIT_TASK_DATE]
@@ -369,51 +382,15 @@ def handle_task_fields(context, message):
     return is_success
 
 
-def handle_intent(update, context, message, intent):
-    """Handle intent retrieved from Dialogflow
+def handle_intent(update, context, intent):
+    """Handle intent retrieved from Dialogflow with its registered handler
 
     Args:
         update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
         intent (IntentResult): the intent result from Dialogflow
     """
-    if intent.all_params_present & (intent.intent == consts.SCHEDULE_MEETING):
-        dojobot.schedule_meeting_intent(context, message, intent)
-    elif intent.intent == consts.MEETING_REMINDER:
-        dojobot.meeting_reminder_intent(context, message)
-    elif intent.intent == consts.MEETING_NO_REMIDNER:
-        dojobot.meeting_no_reminder_intent(context, message)
-    elif intent.intent == consts.MEETING_LIST:
-        dojobot.list_meetings_intent(message, intent)
-    elif intent.intent == consts.STORE_AGENDA:
-        dojobot.store_agenda_intent(context, message, intent)
-    elif intent.intent == consts.GET_AGENDA:
-        dojobot.get_agenda_intent(update, context, intent)
-    elif intent.intent == consts.STORE_NOTES:
-        dojobot.store_notes_intent(context, message, intent)
-    elif intent.intent == consts.GET_NOTES:
-        dojobot.get_notes_intent(update, context, intent)
-    elif intent.intent == consts.CHANGE_REMIND:
-        dojobot.change_reminder_intent(message, intent)
-    elif intent.intent == consts.CANCEL_MEETING:
-        dojobot.cancel_meeting_intent(message, intent)
-    elif intent.intent == consts.CREATE_TASK:
-        dojobot.create_task_intent(context, message, intent)
-    elif intent.intent == consts.UPDATE_TASK:
-        dojobot.update_task_intent(message)
-    elif intent.intent == consts.TASK_LIST:
-        dojobot.list_tasks_intent(update, message)
-    elif intent.intent == consts.LIST_MINE_TASK:
-        dojobot.list_mine_tasks_intent(update, message)
-    elif intent.intent == consts.VOTE:
-        dojobot.vote_intent(context, message)
-    else:
-        reply_markup = None
-        if message.chat.type != Chat.PRIVATE:
-            reply_markup = ForceReply()
-
-        message.reply_text(intent.fulfill_text, reply_markup=reply_markup)
+    dojobot.intent_registry.dispatch(update, context, intent)
 
 
 def handle_audio(update, context):
@@ -424,48 +401,188 @@ def handle_audio(update, context):
         context (Context): the Telegram context object
     """
     message = update.effective_message
-    message.chat.send_action(ChatAction.TYPING)
+    is_addressed = is_voice_addressed(context, message)
+
+    # Forwarded and re-sent voice messages keep their file unique ID
+    recognition = voice_cache.get(message.voice.file_unique_id)
+    if recognition is not None:
+        if is_addressed or recognition.is_mentioned:
+            intent = voice_cache.resolve(recognition, message.from_user.id)
+            result = VoiceResult(
+                intent, 0, 0, recognition.audio_hash, not recognition.needs_replay
+            )
+        else:
+            result = VoiceResult(None, 0, 0, recognition.audio_hash, True)
+
+        handle_voice_result(update, context, is_addressed, result, is_cached=True)
+        return
+
+    if is_addressed:
+        message.chat.send_action(ChatAction.TYPING)
+
+    # Download, transcode and recognise the voice message in a worker process,
+    # only the first seconds of unaddressed voice messages are recognised until
+    # they are known to start with the wake phrase. The result is handled after
+    # the updates of the chat received in the meantime.
     file = message.voice.get_file()
+    is_submitted = voice_workers.submit(
+        recognise_voice,
+        file.file_path,
+        message.from_user.id,
+        is_addressed,
+        callback=functools.partial(
+            context.dispatcher.run_in_chat,
+            message.chat.id,
+            handle_voice_result,
+            update,
+            context,
+            is_addressed,
+        ),
+    )
 
-    with tempfile.NamedTemporaryFile(
-        suffix=".ogg"
-    ) as ogg_file, tempfile.NamedTemporaryFile(suffix=".wav") as wav_file:
-        # Download and convert the voice message into wav format
-        file.download(custom_path=ogg_file.name)
-        ffmpeg.input(ogg_file.name).output(wav_file.name).run(
-            overwrite_output=True, quiet=True
+    if not is_submitted and is_addressed:
+        message.reply_text(
+            "I'm busy with other voice messages at the moment, "
+            "please try again shortly."
         )
-        intent = get_intent(message.from_user.id, input_audio=wav_file.read())
 
-    # Check if the bot should respond to the voice message
-    if message.chat.type == Chat.PRIVATE or (
-        message.chat.type in {Chat.GROUP, Chat.SUPERGROUP}
-        and (
-            intent.is_mentioned
-            or (
-                message.reply_to_message is not None
-                and message.reply_to_message.from_user.id == context.bot.id
-            )
+
+def is_voice_addressed(context, message):
+    """Check if a voice message is addressed to the bot from its metadata
+
+    Args:
+        context (Context): the Telegram context object
+        message (Message): the Telegram message object
+
+    Returns:
+        bool: whether it is sent privately, replies to the bot or mentions
+            the bot in its caption
+    """
+    return message.chat.type == Chat.PRIVATE or (
+        (
+            message.reply_to_message is not None
+            and message.reply_to_message.from_user.id == context.bot.id
         )
-    ):
-        handle_intent(update, context, message, intent)
+        or (
+            message.caption is not None
+            and message.caption.startswith(f"@{context.bot.username}")
+        )
+    )
 
 
-def send_notis(context):
-    """Send notifications of meeting reminders
+def handle_voice_result(update, context, is_addressed, result, is_cached=False):
+    """Handle the recognised intent of a voice message
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
+        is_addressed (bool): whether the voice message is addressed to the bot
+        result (VoiceResult): the voice recognition result, None if the voice
+            message couldn't be recognised
+        is_cached (bool, optional): whether the result came from the voice
+            cache by its file. Defaults to False.
     """
-    notis = database.get_passed_notis()
-    for noti in notis:
-        context.bot.send_message(noti.chat_id, noti.text, parse_mode=ParseMode.HTML)
-        if noti.doc_id is not None:
-            context.bot.send_document(
-                noti.chat_id, noti.doc_id, caption=noti.doc_caption
-            )
+    if result is None:
+        return
+
+    message = update.effective_message
+    intent = result.intent
+    is_mentioned = intent is not None and intent.is_mentioned
+    voice_stats.record(is_addressed, is_mentioned, result.is_avoided)
+    if result.bytes_sent:
+        voice_stats.record_audio(result.bytes_sent, result.bytes_saved)
 
-        database.delete_noti(noti.noti_id)
+    if intent is not None and not is_cached:
+        voice_cache.add(message.voice.file_unique_id, result.audio_hash, intent)
+
+    # Check if the bot should respond to the voice message
+    if intent is not None and (is_addressed or is_mentioned):
+        # The conversation may have moved on in another shard while the voice
+        # message was being recognised
+        context.refresh_data()
+        handle_intent(update, context, intent)
+        context.dispatcher.update_persistence(update)
+
+
+def send_notis(bot, noti_ids):
+    """Send notifications of meeting reminders
+
+    The notifications are claimed with a lease before they are sent and deleted
+    together afterwards, so they are only sent by one sender. Notifications
+    that failed to send or weren't acknowledged because the sender stopped are
+    claimed again by the reclaim job once their lease expires, until they have
+    been claimed NOTI_MAX_ATTEMPTS times.
+
+    Args:
+        bot (Bot): the Telegram bot object
+        noti_ids (list): the IDs of the due notifications
+    """
+    with database.unit_of_work():
+        notis = database.claim_notis(
+            noti_ids, NOTI_SENDER_ID, arrow.utcnow().shift(seconds=NOTI_LEASE_SECONDS)
+        )
+
+    sent_ids = []
+    try:
+        for noti in notis:
+            if noti.attempts > NOTI_MAX_ATTEMPTS:
+                LOGGER.warning(
+                    "Dropped notification %d after %d attempts",
+                    noti.noti_id,
+                    NOTI_MAX_ATTEMPTS,
+                )
+                sent_ids.append(noti.noti_id)
+                continue
+
+            try:
+                try:
+                    send_noti(bot, noti, noti.chat_id)
+                except ChatMigrated as e:
+                    # The group has been upgraded to a supergroup with a new ID
+                    send_noti(bot, noti, e.new_chat_id)
+            except (BadRequest, Unauthorized, ChatMigrated):
+                # The chat is gone or the bot was removed, retrying won't help
+                LOGGER.warning("Dropped notification %d", noti.noti_id, exc_info=True)
+            except TelegramError:
+                LOGGER.exception("Failed to send notification %d", noti.noti_id)
+                continue
+
+            sent_ids.append(noti.noti_id)
+    finally:
+        with database.unit_of_work():
+            database.ack_notis(sent_ids, NOTI_SENDER_ID)
+
+
+def send_noti(bot, noti, chat_id):
+    """Send a notification and its document
+
+    Args:
+        bot (Bot): the Telegram bot object
+        noti (Notifications): the notification
+        chat_id (int): the chat ID to send it to
+    """
+    bot.send_message(chat_id, noti.text, parse_mode=ParseMode.HTML)
+    if noti.doc_id is not None:
+        bot.send_document(chat_id, noti.doc_id, caption=noti.doc_caption)
+
+
+def reclaim_notis(context):
+    """Send overdue notifications that no sender holds a lease on
+
+    Args:
+        context (Context): the Telegram context object, the job context is the
+            shard of this process
+    """
+    shard = context.job.context
+    with database.unit_of_work():
+        notis = database.get_unclaimed_notis(
+            arrow.utcnow().shift(seconds=-NOTI_LEASE_SECONDS)
+        )
+        noti_ids = [noti.noti_id for noti in notis if shard.owns(noti.chat_id)]
+
+    if noti_ids:
+        LOGGER.info("Reclaimed %d notifications", len(noti_ids))
+        send_notis(context.bot, noti_ids)
 
 
 def store_document(update, context):
@@ -476,9 +593,6 @@ def store_document(update, context):
         context (Context): the Telegram context object
     """
     message = update.effective_message
-    if not should_respond_message(context, message):
-        return
-
     key = doc_type = None
     if consts.STORE_NOTES in context.user_data:
         key = consts.STORE_NOTES
@@ -508,39 +622,22 @@ def store_document(update, context):
         del context.user_data[key]
 
 
-def should_respond_message(context, message):
-    """Check if bot should respond to the message
-
-    Args:
-        context (Context): the context object
-        message (Message): the message object
-
-    Returns:
-        bool: whether the bot should respond
-    """
-    return message.chat.type == Chat.PRIVATE or (
-        message.chat.type in {Chat.GROUP, Chat.SUPERGROUP}
-        and (
-            (
-                message.text is not None
-                and message.text.startswith(f"@{context.bot.username}")
-            )
-            or (
-                message.reply_to_message is not None
-                and message.reply_to_message.from_user.id == context.bot.id
-            )
-        )
-    )
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-d", "--init_db", action="store_true", help="Initialise database"
     )
+    parser.add_argument(
+        "-u",
+        "--upgrade_db",
+        action="store_true",
+        help="Create missing tables and indexes without dropping data",
+    )
     args = parser.parse_args()
 
     if args.init_db:
         init_db()
+    elif args.upgrade_db:
+        upgrade_db()
     else:
         main()
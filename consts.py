@@ -15,6 +15,15 @@ CHANGE_REMIND = "change_remind"
 CANCEL_MEETING = "meeting.cancel"
 VOTE = "vote"
 
+# Meeting callback query opcodes
+REMIND_MAIN = "remind_main"
+REMIND_MENU = "remind_menu"
+CANCEL_CHANGE_REMIND = "cancel_change_reminder"
+CANCEL_MEETING_MAIN = "cancel_meeting_main"
+CANCEL_MEETING_MENU = "cancel_meeting_menu"
+CONFIRM_CANCEL_MEETING = "confirm_cancel_meeting"
+CANCEL_CANCEL_MEETING = "cancel_cancel_meeting"
+
 # Task related constants
 CREATE_TASK = "create_task"
 UPDATE_TASK = "task.update"
@@ -0,0 +1,423 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue, Updater
+from telegram.utils.request import Request
+
+from db import database
+from persistence import DatabasePersistence
+
+LOGGER = logging.getLogger(__name__)
+
+# Tells a chat worker to stop, None is a valid chat key
+_STOP = object()
+
+
+def get_update_key(update):
+    """Get the key of the update that its processing is ordered by
+
+    Args:
+        update (Update): the Telegram update object
+
+    Returns:
+        int or str: the chat ID, the poll ID for poll updates without a chat, or
+            None for other updates
+    """
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+
+    if update.poll is not None:
+        return update.poll.id
+
+    if update.poll_answer is not None:
+        return update.poll_answer.poll_id
+
+    return None
+
+
+def get_queue_stats(stats):
+    """Build the statistics of a chat queue
+
+    Args:
+        stats (list): the number of jobs, the maximum queue length, the total
+            and the maximum wait in seconds
+
+    Returns:
+        dict: the statistics
+    """
+    jobs, max_queued, total_wait, max_wait = stats
+    return {
+        "jobs": jobs,
+        "max_queued": max_queued,
+        "avg_wait": total_wait / jobs if jobs else 0.0,
+        "max_wait": max_wait,
+    }
+
+
+class ChatWorkerPool:
+    """Pool of worker threads that runs jobs of different chats in parallel and
+    jobs of the same chat one at a time in the order they were submitted
+
+    Each chat has its own queue of jobs, and a chat with queued jobs is handed
+    to one worker at a time. After running one job the worker puts the chat
+    back at the end of the ready queue, so a busy chat can't starve the others.
+
+    The number of queued and running jobs is bounded. Blocking submits wait for
+    a free slot, so a full pool stops the dispatcher from taking more updates
+    off the update queue and the backlog builds up there instead.
+    """
+
+    def __init__(self, workers=8, max_pending=0):
+        """
+        Args:
+            workers (int, optional): the number of worker threads. Defaults to 8.
+            max_pending (int, optional): the maximum number of queued and running
+                jobs, 0 for no limit. Defaults to 0.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.num_pending = 0
+        self._queues = {}
+        self._chat_stats = {}
+        self._total_stats = [0, 0, 0.0, 0.0]
+        self._ready = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+
+    def start(self):
+        """Start the worker threads"""
+        with self._lock:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"chat_worker_{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, key, fn, *args, block=True):
+        """Queue a job behind the other jobs of the chat
+
+        Args:
+            key (int or str): the chat key
+            fn (callable): the job function
+            *args: the function arguments
+            block (bool, optional): whether to wait until the number of pending
+                jobs is below the limit, jobs that finish work that was already
+                accepted skip the wait. Defaults to True.
+        """
+        with self._lock:
+            while block and self.max_pending and self.num_pending >= self.max_pending:
+                self._has_room.wait()
+
+            queue = self._queues.get(key)
+            is_idle = queue is None
+            if is_idle:
+                queue = self._queues[key] = deque()
+
+            queue.append((fn, args, time.monotonic()))
+            self.num_pending += 1
+
+            stats = self._chat_stats.setdefault(key, [0, 0, 0.0, 0.0])
+            stats[1] = max(stats[1], len(queue))
+
+        # Chats that already have queued jobs are already in the ready queue or
+        # being worked on
+        if is_idle:
+            self._ready.put(key)
+
+    def shutdown(self):
+        """Wait for the queued jobs and stop the worker threads"""
+        with self._idle:
+            while self.num_pending:
+                self._idle.wait()
+
+            threads = self._threads
+            self._threads = []
+
+        for _ in threads:
+            self._ready.put(_STOP)
+
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        """Get the queue statistics of all chats and of the chats with queued
+        jobs, a chat's statistics are folded into the totals once its queue is
+        empty
+
+        Returns:
+            dict: the number of pending jobs, the statistics of all chats and of
+                each chat with queued jobs, times are in seconds
+                {"pending": int, "total": {"jobs": int, "max_queued": int,
+                "avg_wait": float, "max_wait": float}, "chats": {key: {"jobs":
+                int, "queued": int, "max_queued": int, "avg_wait": float,
+                "max_wait": float}}}
+        """
+        with self._lock:
+            chats = {}
+            for key, stats in self._chat_stats.items():
+                chats[key] = get_queue_stats(stats)
+                chats[key]["queued"] = len(self._queues.get(key, ()))
+
+            return {
+                "pending": self.num_pending,
+                "total": get_queue_stats(self._total_stats),
+                "chats": chats,
+            }
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+
+            with self._lock:
+                fn, args, submitted_at = self._queues[key][0]
+                wait = time.monotonic() - submitted_at
+                stats = self._chat_stats[key]
+                stats[0] += 1
+                stats[2] += wait
+                stats[3] = max(stats[3], wait)
+
+            try:
+                fn(*args)
+            except Exception:
+                LOGGER.exception("Chat job failed")
+
+            # The job is only removed once it has finished, so the chat can't be
+            # put in the ready queue again while it is running
+            with self._lock:
+                queue = self._queues[key]
+                queue.popleft()
+                self.num_pending -= 1
+                self._has_room.notify()
+                is_idle = not queue
+                if is_idle:
+                    del self._queues[key]
+                    self._fold_stats(self._chat_stats.pop(key))
+
+                if not self.num_pending:
+                    self._idle.notify_all()
+
+            if not is_idle:
+                self._ready.put(key)
+
+    def _fold_stats(self, stats):
+        jobs, max_queued, total_wait, max_wait = stats
+        totals = self._total_stats
+        totals[0] += jobs
+        totals[1] = max(totals[1], max_queued)
+        totals[2] += total_wait
+        totals[3] = max(totals[3], max_wait)
+
+
+class BotDispatcher(Dispatcher):
+    """Dispatcher that processes each update within its own database unit of
+    work, so all handlers of an update share one session
+
+    The changes of an update are committed before each Telegram call and once
+    it has been processed, a handler error rolls back the changes made since
+    the last commit.
+
+    Updates are processed by a pool of chat workers instead of the dispatcher
+    thread. Updates of different chats are processed in parallel, while updates
+    of the same chat are processed one at a time in the order they were
+    received, so the multi-step flows kept in user_data stay consistent.
+
+    When the bot runs as one of several shards, updates of chats owned by other
+    shards are dropped, and user data is kept in the database so conversations
+    continue in chats of other shards.
+    """
+
+    def __init__(self, *args, chat_workers=8, max_pending=0, shard=None, **kwargs):
+        """
+        Args:
+            *args: the Dispatcher arguments
+            chat_workers (int, optional): the number of chat worker threads.
+                Defaults to 8.
+            max_pending (int, optional): the maximum number of updates being
+                processed by the chat workers, 0 for no limit. Defaults to 0.
+            shard (ShardConfig, optional): the chats this process owns.
+                Defaults to None.
+            **kwargs: the Dispatcher keyword arguments
+        """
+        super().__init__(*args, **kwargs)
+        self.chat_workers = ChatWorkerPool(chat_workers, max_pending)
+        self.shard = shard
+        self.num_unowned = 0
+
+    def start(self, ready=None):
+        self.chat_workers.start()
+        super().start(ready)
+
+    def process_update(self, update):
+        if isinstance(update, Update):
+            chat = update.effective_chat
+            if chat is not None and not self.owns_chat(chat.id):
+                LOGGER.warning("Dropped update of chat %d of another shard", chat.id)
+                self.num_unowned += 1
+                return
+
+            # Waits while the chat workers are full, so the update queue fills up
+            # and the webhook refuses further updates
+            self.chat_workers.submit(
+                get_update_key(update),
+                self._run_update,
+                super().process_update,
+                (update,),
+            )
+        else:
+            self._run_update(super().process_update, (update,))
+
+    def dispatch_error(self, update, error, promise=None):
+        # Handler errors are caught by process_update before they reach the
+        # unit of work of the update, which would commit the partial changes
+        database.mark_failed()
+        super().dispatch_error(update, error, promise)
+
+    def owns_chat(self, chat_id):
+        """Check if this process handles the chat
+
+        Args:
+            chat_id (int): the chat ID
+
+        Returns:
+            bool: whether the chat is owned by the shard of this process
+        """
+        return self.shard is None or self.shard.owns(chat_id)
+
+    def run_in_chat(self, key, fn, *args):
+        """Run the function within a database unit of work after the updates of
+        the chat that have already been received
+
+        Args:
+            key (int or str): the chat key
+            fn (callable): the function
+            *args: the function arguments
+        """
+        self.chat_workers.submit(key, self._run_update, fn, args, block=False)
+
+    @staticmethod
+    def _run_update(fn, args):
+        with database.unit_of_work():
+            fn(*args)
+
+
+class CheckpointRequest(Request):
+    """Bot API request that commits the current unit of work before calling
+    Telegram, so the database isn't locked while waiting on the network
+    """
+
+    def post(self, url, data, timeout=None):
+        database.checkpoint()
+        return super().post(url, data, timeout=timeout)
+
+
+class BotUpdater(Updater):
+    """Updater that can also receive updates through our own webhook server"""
+
+    def start_webhook_server(
+        self, server, webhook_url, drop_pending_updates=False, register=True
+    ):
+        """Register the webhook with Telegram and start receiving updates
+
+        Args:
+            server (WebhookServer): the webhook server
+            webhook_url (str): the public URL of the webhook
+            drop_pending_updates (bool, optional): whether to drop the updates
+                Telegram is holding for the bot. Defaults to False.
+            register (bool, optional): whether to register the webhook, shards
+                receive their updates from the shard router which registers its
+                own webhook instead. Defaults to True.
+
+        Returns:
+            Queue: the update queue, None if the updater is already running
+        """
+        if self.running:
+            return None
+
+        self.running = True
+        self.job_queue.start()
+        dispatcher_ready = threading.Event()
+        self._init_thread(self.dispatcher.start, "dispatcher", ready=dispatcher_ready)
+
+        # The updater shuts the server down when it is stopped
+        self.httpd = server
+        self._init_thread(server.serve_forever, "webhook")
+        dispatcher_ready.wait()
+
+        if register:
+            self.bot.set_webhook(
+                webhook_url,
+                secret_token=server.secret_token,
+                drop_pending_updates=drop_pending_updates,
+            )
+
+        return self.update_queue
+
+
+def create_updater(
+    token,
+    workers=4,
+    chat_workers=8,
+    queue_size=0,
+    base_url=None,
+    base_file_url=None,
+    shard=None,
+):
+    """Create the updater with our own dispatcher
+
+    Args:
+        token (str): the Telegram bot token
+        workers (int, optional): the number of dispatcher worker threads.
+            Defaults to 4.
+        chat_workers (int, optional): the number of threads that process
+            updates. Defaults to 8.
+        queue_size (int, optional): the maximum number of received updates
+            waiting to be dispatched, and of updates being processed, 0 for no
+            limit. Defaults to 0.
+        base_url (str, optional): the Bot API URL, such as the URL of a fake
+            Telegram server. Defaults to None.
+        base_file_url (str, optional): the Bot API file download URL.
+            Defaults to None.
+        shard (ShardConfig, optional): the chats this process owns.
+            Defaults to None.
+
+    Returns:
+        BotUpdater: the Telegram updater object
+    """
+    # A connection for each worker, the dispatcher, the updater, the job queue
+    # and the main thread
+    bot = Bot(
+        token,
+        base_url=base_url,
+        base_file_url=base_file_url,
+        request=CheckpointRequest(con_pool_size=workers + chat_workers + 4),
+    )
+    job_queue = JobQueue()
+    dispatcher = BotDispatcher(
+        bot,
+        Queue(queue_size),
+        workers=workers,
+        job_queue=job_queue,
+        chat_workers=chat_workers,
+        max_pending=queue_size,
+        shard=shard,
+        persistence=DatabasePersistence()
+        if shard is not None and shard.is_sharded
+        else None,
+    )
+    job_queue.set_dispatcher(dispatcher)
+
+    # The workers belong to the dispatcher, the updater rejects its default count
+    return BotUpdater(dispatcher=dispatcher, workers=None)
@@ -1,3 +1,6 @@
+from .tokens import CallbackTokenStore, callback_tokens  # noqa
+from .callbacks import CallbackRouter, callback_router  # noqa
+from .intents import IntentRegistry, default_intent, intent_registry  # noqa
 from .meeting import (  # noqa
     schedule_meeting_intent,
     meeting_reminder_intent,
@@ -0,0 +1,110 @@
+import logging
+
+from dojobot.tokens import TOKEN_PREFIX, callback_tokens
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CallbackRouter:
+    """Route callback queries to their handlers by opcode
+
+    Callback data is "opcode" or "opcode,arg1,arg2,...". It is parsed once,
+    the arguments are set as context.args and the handler of the opcode is
+    found with a single lookup, so all buttons share one CallbackQueryHandler.
+    Callback data can also be a token issued by the callback token store, the
+    opcode and arguments are then looked up from the token. Buttons sent before
+    the comma separated format packed the argument right after a short prefix,
+    those are still routed by their legacy prefix.
+    """
+
+    def __init__(self, token_store=None):
+        """
+        Args:
+            token_store (CallbackTokenStore, optional): the store of the callback
+                tokens. Defaults to None.
+        """
+        self.token_store = token_store
+        self._handlers = {}
+        self._legacy_prefixes = {}
+
+    def register(self, *opcodes, legacy_prefix=None):
+        """Register the decorated function as the handler of the opcodes
+
+        Args:
+            *opcodes (str): the callback opcodes
+            legacy_prefix (str, optional): the prefix of buttons in the legacy
+                format. Defaults to None.
+
+        Returns:
+            callable: the decorator
+        """
+
+        def decorator(handler):
+            for opcode in opcodes:
+                if opcode in self._handlers:
+                    raise ValueError(f"Callback {opcode} already has a handler")
+
+                self._handlers[opcode] = handler
+
+            if legacy_prefix is not None:
+                self._legacy_prefixes[legacy_prefix] = handler
+
+            return handler
+
+        return decorator
+
+    def handle(self, update, context):
+        """Callback query handler that calls the handler of the opcode
+
+        Args:
+            update (Update): the Telegram update object
+            context (Context): the Telegram context object
+        """
+        query = update.callback_query
+        # Game callback queries have no data
+        data = query.data or ""
+        handler, args = self.route(data)
+
+        if handler is None:
+            if self.token_store is not None and data.startswith(TOKEN_PREFIX):
+                query.answer("This button has expired, please try again.")
+            else:
+                LOGGER.warning("Unknown callback query data: %s", query.data)
+                query.answer()
+
+            return
+
+        context.args = args
+        handler(update, context)
+
+    def route(self, data):
+        """Find the handler of the callback data
+
+        Args:
+            data (str): the callback data
+
+        Returns:
+            tuple: the handler, None if there isn't one, and the list of arguments
+        """
+        if self.token_store is not None and data.startswith(TOKEN_PREFIX):
+            payload = self.token_store.resolve(data)
+            if payload is None:
+                return None, []
+
+            opcode, args = payload
+            return self._handlers.get(opcode), args
+
+        opcode, _, args = data.partition(",")
+        handler = self._handlers.get(opcode)
+        if handler is not None:
+            return handler, args.split(",") if args else []
+
+        for prefix, handler in self._legacy_prefixes.items():
+            arg = data.replace(prefix, "", 1)
+            if data.startswith(prefix) and arg.isdigit():
+                return handler, [arg]
+
+        return None, []
+
+
+callback_router = CallbackRouter(callback_tokens)
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from db import database
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ReplyMarkupCoalescer:
+    """Coalesce reply markup edits of the same message
+
+    The first edit of a message is sent right away, any further edits within
+    the window are collected and only the latest keyboard state is sent once
+    the window has passed. This keeps bursts of button presses within
+    Telegram's per-chat edit limits.
+    """
+
+    def __init__(self, window=1.5):
+        """
+        Args:
+            window (float, optional): the minimum seconds between two edits of the
+                same message. Defaults to 1.5.
+        """
+        self.window = window
+        self.num_submitted = 0
+        self.num_sent = 0
+        self._lock = threading.Lock()
+        self._last_edits = {}
+        self._pending = {}
+
+    def submit(self, bot, chat_id, message_id, build_markup):
+        """Submit an edit of the message reply markup
+
+        Args:
+            bot (Bot): the Telegram bot object
+            chat_id (int): the chat ID
+            message_id (int): the message ID
+            build_markup (callable): returns the latest reply markup, it is called
+                when the edit is sent
+        """
+        key = (chat_id, message_id)
+        now = time.monotonic()
+
+        with self._lock:
+            self.num_submitted += 1
+            if key in self._pending:
+                self._pending[key] = (bot, build_markup)
+                return
+
+            delay = self._last_edits.get(key, 0) + self.window - now
+            if delay > 0:
+                self._schedule(key, bot, build_markup, delay)
+                return
+
+            self._last_edits[key] = now
+            self._prune(now)
+
+        self._edit(key, bot, build_markup)
+
+    def _schedule(self, key, bot, build_markup, delay):
+        self._pending[key] = (bot, build_markup)
+        timer = threading.Timer(delay, self._flush, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self, key):
+        with self._lock:
+            bot, build_markup = self._pending.pop(key)
+            self._last_edits[key] = time.monotonic()
+
+        with database.unit_of_work():
+            self._edit(key, bot, build_markup)
+
+    def _edit(self, key, bot, build_markup):
+        chat_id, message_id = key
+        try:
+            bot.edit_message_reply_markup(
+                chat_id, message_id, reply_markup=build_markup()
+            )
+            with self._lock:
+                self.num_sent += 1
+        except RetryAfter as e:
+            # Retry with the latest keyboard state once we're allowed to
+            with self._lock:
+                if key not in self._pending:
+                    self._schedule(key, bot, build_markup, e.retry_after)
+        except BadRequest as e:
+            if "not modified" not in e.message.lower():
+                LOGGER.warning("Failed to edit reply markup of %s: %s", key, e)
+        except TelegramError as e:
+            LOGGER.warning("Failed to edit reply markup of %s: %s", key, e)
+
+    def _prune(self, now):
+        """Forget about messages that haven't been edited within the window"""
+        if len(self._last_edits) > 1000:
+            self._last_edits = {
+                key: last_edit
+                for key, last_edit in self._last_edits.items()
+                if now - last_edit < self.window or key in self._pending
+            }
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from telegram import Chat, ForceReply
+
+# The stats key of intents handled by the default handler
+DEFAULT_INTENT = "default"
+
+
+class IntentRegistry:
+    """Map intent names to their handlers
+
+    Handlers take the update, context and intent result, and are registered
+    against the consts intent names with the register decorator. Intents
+    without a handler get the NLU fulfillment text as the reply. The number of
+    calls, errors and time spent are recorded for each intent.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, *intents):
+        """Register the decorated function as the handler of the intents
+
+        Args:
+            *intents (str): the intent names
+
+        Returns:
+            callable: the decorator
+        """
+
+        def decorator(handler):
+            for intent in intents:
+                if intent in self._handlers:
+                    raise ValueError(f"Intent {intent} already has a handler")
+
+                self._handlers[intent] = handler
+
+            return handler
+
+        return decorator
+
+    def dispatch(self, update, context, intent):
+        """Call the handler of the intent
+
+        Args:
+            update (Update): the Telegram update object
+            context (Context): the Telegram context object
+            intent (IntentResult): the intent result
+        """
+        handler = self._handlers.get(intent.intent)
+        name = intent.intent
+        if handler is None:
+            handler = default_intent
+            name = DEFAULT_INTENT
+
+        start = time.monotonic()
+        is_failed = True
+        try:
+            handler(update, context, intent)
+            is_failed = False
+        finally:
+            self._record(name, time.monotonic() - start, is_failed)
+
+    def stats(self):
+        """Get the statistics of each intent
+
+        Returns:
+            dict: the statistics of each intent, times are in seconds
+                {intent: {"calls": int, "errors": int, "avg_time": float,
+                "max_time": float}}
+        """
+        with self._lock:
+            return {
+                name: {
+                    "calls": calls,
+                    "errors": errors,
+                    "avg_time": total_time / calls,
+                    "max_time": max_time,
+                }
+                for name, (calls, errors, total_time, max_time) in self._stats.items()
+            }
+
+    def _record(self, name, duration, is_failed):
+        with self._lock:
+            calls, errors, total_time, max_time = self._stats.get(
+                name, (0, 0, 0.0, 0.0)
+            )
+            self._stats[name] = (
+                calls + 1,
+                errors + is_failed,
+                total_time + duration,
+                max(max_time, duration),
+            )
+
+
+def default_intent(update, context, intent):
+    """Reply with the fulfillment text of the intent
+
+    Args:
+        update (Update): the Telegram update object
+        context (Context): the Telegram context object
+        intent (IntentResult): the intent result
+    """
+    # Unrecognised audio can come back without any fulfillment text
+    if not intent.fulfill_text:
+        return
+
+    message = update.effective_message
+    reply_markup = None
+    if message.chat.type != Chat.PRIVATE:
+        reply_markup = ForceReply()
+
+    message.reply_text(intent.fulfill_text, reply_markup=reply_markup)
+
+
+intent_registry = IntentRegistry()
@@ -4,17 +4,25 @@ from telegram import KeyboardButton, ParseMode, ReplyKeyboardMarkup, ReplyKeyboa
 
 import consts
 from db import database
+from dojobot.intents import default_intent, intent_registry
 from models import Meetings
 
 
-def schedule_meeting_intent(context, message, intent):
+@intent_registry.register(consts.SCHEDULE_MEETING)
+def schedule_meeting_intent(update, context, intent):
     """Handle schedule meeting intent
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
         intent (IntentResult): the intent result from Dialogflow
     """
+    # Dialogflow asks for the missing details in its fulfillment text
+    if not intent.all_params_present:
+        default_intent(update, context, intent)
+        return
+
+    message = update.effective_message
     if intent.params["datetime"] < arrow.now():
         message.reply_text("Can't schedule a meeting in the past")
     else:
@@ -80,13 +88,16 @@ def check_meeting_conflict(message, intent):
     return is_conflict
 
 
-def meeting_reminder_intent(context, message):
+@intent_registry.register(consts.MEETING_REMINDER)
+def meeting_reminder_intent(update, context, intent):
     """Handle set meeting reminder intent
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     if consts.SCHEDULE_MEETING in context.user_data:
         meeting = context.user_data[consts.SCHEDULE_MEETING]
         database.set_remind(meeting.meeting_id, message.chat.id)
@@ -97,13 +108,16 @@ def meeting_reminder_intent(context, message):
         )
 
 
-def meeting_no_reminder_intent(context, message):
+@intent_registry.register(consts.MEETING_NO_REMIDNER)
+def meeting_no_reminder_intent(update, context, intent):
     """Handle not setting meeting reminder intent
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     if consts.SCHEDULE_MEETING in context.user_data:
         del context.user_data[consts.SCHEDULE_MEETING]
         message.reply_text(
@@ -112,13 +126,16 @@ def meeting_no_reminder_intent(context, message):
         )
 
 
-def list_meetings_intent(message, intent):
+@intent_registry.register(consts.MEETING_LIST)
+def list_meetings_intent(update, context, intent):
     """Handle list meetings intent
 
     Args:
-        message (Message): the Telegram message intent
+        update (Update): the Telegram update object
+        context (Context): the Telegram context object
         intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     meetings = database.get_meetings(message.chat_id, after=arrow.utcnow())
     reply = intent.fulfill_text + "\n"
     i = 1
@@ -1,16 +1,22 @@
 import arrow
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 
+import consts
 from db import database
+from dojobot.callbacks import callback_router
+from dojobot.intents import intent_registry
 
 
-def cancel_meeting_intent(message, intent):
+@intent_registry.register(consts.CANCEL_MEETING)
+def cancel_meeting_intent(update, context, intent):
     """Handle cancel meeting intent
 
     Args:
-        message (Message): the Telegram message object
+        update (Update): the Telegram update object
+        context (Context): the Telegram context object
         intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     datetime = intent.params["datetime"]
 
     # Cancel meeting with a given meeting datetime
@@ -21,10 +27,20 @@ def cancel_meeting_intent(message, intent):
                 "No meeting found with the given date and time. Please try again."
             )
         else:
-            # cm: cancel_meeting
             keyboard = [
-                [InlineKeyboardButton("Yes", callback_data=f"cm{meeting.meeting_id}")],
-                [InlineKeyboardButton("No", callback_data="cancel_cancel_meeting")],
+                [
+                    InlineKeyboardButton(
+                        "Yes",
+                        callback_data=(
+                            f"{consts.CONFIRM_CANCEL_MEETING},{meeting.meeting_id}"
+                        ),
+                    )
+                ],
+                [
+                    InlineKeyboardButton(
+                        "No", callback_data=consts.CANCEL_CANCEL_MEETING
+                    )
+                ],
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             message.reply_text(
@@ -47,6 +63,7 @@ def cancel_meeting_intent(message, intent):
             )
 
 
+@callback_router.register(consts.CONFIRM_CANCEL_MEETING, legacy_prefix="cm")
 def cancel_meeting(update, context):
     """Cancel meeting callback query handler
 
@@ -56,7 +73,7 @@ def cancel_meeting(update, context):
 
     """
     query = update.callback_query
-    meeting_id = query.data[2:]
+    meeting_id = context.args[0]
     query.answer()
     meeting = database.get_meeting_by_id(meeting_id)
 
@@ -76,6 +93,7 @@ def cancel_meeting(update, context):
 
 
 # ---------------------------------------- MENU ----------------------------------------
+@callback_router.register(consts.CANCEL_MEETING_MAIN)
 def cancel_meeting_main_menu(update, context):
     """Send the list of meetings for user to choose to cancel
 
@@ -112,20 +130,21 @@ def cancel_meeting_main_menu_keyboard(team_id):
                 InlineKeyboardButton(
                     meeting.formatted_datetime(),
                     # cf: cancel_meeting_first
-                    callback_data=f"cf{meeting.meeting_id}",
+                    callback_data=f"{consts.CANCEL_MEETING_MENU},{meeting.meeting_id}",
                 )
             ]
         )
 
     if keyboard:
         keyboard.append(
-            [InlineKeyboardButton("Cancel", callback_data="cancel_cancel_meeting")]
+            [InlineKeyboardButton("Cancel", callback_data=consts.CANCEL_CANCEL_MEETING)]
         )
         reply_markup = InlineKeyboardMarkup(keyboard)
 
     return reply_markup
 
 
+@callback_router.register(consts.CANCEL_MEETING_MENU, legacy_prefix="cf")
 def cancel_meeting_first_menu(update, context):
     """Send the confirm to cancle meeting keyboard
 
@@ -135,7 +154,7 @@ def cancel_meeting_first_menu(update, context):
     """
     query = update.callback_query
     query.answer()
-    temp = query.data[2:]
+    temp = context.args[0]
     query.edit_message_text(
         text=(
             "Are you sure you want to cancel the meeting at "
@@ -156,8 +175,10 @@ def cancel_meeting_first_menu_keyboard(meeting_id):
         InlineKeyboardMarkup: the cancel meeting keyboard
     """
     keyboard = [
-        InlineKeyboardButton("Yes", callback_data=f"cm{meeting_id}"),
-        InlineKeyboardButton("No", callback_data="cancel_meeting_main"),
+        InlineKeyboardButton(
+            "Yes", callback_data=f"{consts.CONFIRM_CANCEL_MEETING},{meeting_id}"
+        ),
+        InlineKeyboardButton("No", callback_data=consts.CANCEL_MEETING_MAIN),
     ]
 
     return InlineKeyboardMarkup([keyboard])
@@ -3,15 +3,20 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 
 import consts
 from db import database
+from dojobot.callbacks import callback_router
+from dojobot.intents import intent_registry
 
 
-def change_reminder_intent(message, intent):
+@intent_registry.register(consts.CHANGE_REMIND)
+def change_reminder_intent(update, context, intent):
     """Handle change meeting reminder intent
 
     Args:
-        message (Message): the Telegram message object
+        update (Update): the Telegram update object
+        context (Context): the Telegram context object
         intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     datetime = intent.params["datetime"]
 
     # Change meeting reminder with a given datetime
@@ -59,6 +64,7 @@ def change_reminder_intent(message, intent):
             )
 
 
+@callback_router.register(consts.CHANGE_REMIND)
 def change_remind(update, context):
     """Change meeting reminder callback query handler
 
@@ -67,7 +73,7 @@ def change_remind(update, context):
         context (Context): the Telegram context object
     """
     query = update.callback_query
-    _, meeting_id = query.data.split(",")
+    meeting_id = context.args[0]
     chat_id = query.message.chat.id
     query.answer()
     meeting = database.get_meeting_by_id(meeting_id)
@@ -90,6 +96,7 @@ def change_remind(update, context):
     query.edit_message_text(text=text, parse_mode=ParseMode.HTML)
 
 
+@callback_router.register(consts.CANCEL_CHANGE_REMIND, consts.CANCEL_CANCEL_MEETING)
 def cancel_del(update, context):
     """Cancel change meeting reminder callback query handler
 
@@ -103,6 +110,7 @@ def cancel_del(update, context):
 
 
 # ---------------------------------------- MENU ----------------------------------------
+@callback_router.register(consts.REMIND_MAIN)
 def remind_main_menu(update, context):
     """Send the list of meetings for user to choose to change the reminder setting
 
@@ -141,20 +149,21 @@ def remind_main_menu_keyboard(chat_id):
             [
                 InlineKeyboardButton(
                     meeting.formatted_datetime(),
-                    callback_data=f"rf{meeting.meeting_id}",
+                    callback_data=f"{consts.REMIND_MENU},{meeting.meeting_id}",
                 )
             ]
         )
 
     if keyboard:
         keyboard.append(
-            [InlineKeyboardButton("Cancel", callback_data="cancel_change_reminder")]
+            [InlineKeyboardButton("Cancel", callback_data=consts.CANCEL_CHANGE_REMIND)]
         )
         reply_markup = InlineKeyboardMarkup(keyboard)
 
     return reply_markup
 
 
+@callback_router.register(consts.REMIND_MENU, legacy_prefix="rf")
 def remind_first_menu(update, context):
     """Show the current status of the meeting reminder, and allow user to change it
 
@@ -164,7 +173,7 @@ def remind_first_menu(update, context):
     """
     query = update.callback_query
     query.answer()
-    meeting_id = query.data[2:]
+    meeting_id = context.args[0]
     meeting = database.get_meeting_by_id(meeting_id)
 
     if meeting is not None:
@@ -195,7 +204,7 @@ def remind_first_menu_keyboard(meeting_id, check):
     Returns:
         InlineKeyboardMarkup: the keyboard to toggle meeting reminder
     """
-    keyboard = [InlineKeyboardButton("Go back", callback_data="remind_main")]
+    keyboard = [InlineKeyboardButton("Go back", callback_data=consts.REMIND_MAIN)]
     callback_data = f"{consts.CHANGE_REMIND},{meeting_id}"
 
     if check:
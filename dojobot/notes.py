@@ -6,16 +6,20 @@ import consts
 
 from db import database
 from dojobot import utils
+from dojobot.callbacks import callback_router
+from dojobot.intents import intent_registry
 
 
-def store_notes_intent(context, message, intent):
+@intent_registry.register(consts.STORE_NOTES)
+def store_notes_intent(update, context, intent):
     """Handle store notes intent
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
         intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     datetime = intent.params["datetime"]
     if datetime is not None:
         store_notes_with_datetime(context, message, datetime)
@@ -117,6 +121,7 @@ def store_notes_without_datetime(message):
         )
 
 
+@callback_router.register(consts.STORE_NOTES)
 def store_notes_callback(update, context):
     """Store meeting notes callback query handler
 
@@ -126,7 +131,7 @@ def store_notes_callback(update, context):
     """
     query = update.callback_query
     query.answer()
-    _, meeting_id = query.data.split(",")
+    meeting_id = context.args[0]
 
     if meeting_id == "no":
         query.edit_message_text("Cancelled for storing meeting notes")
@@ -172,6 +177,7 @@ def edit_store_notes_msg(context, query, meeting_id):
             utils.edit_query_message(context, query, text)
 
 
+@intent_registry.register(consts.GET_NOTES)
 def get_notes_intent(update, context, intent):
     """Handle get notes intent
 
@@ -239,6 +245,7 @@ def get_notes_without_datetime(message):
         message.reply_text("No meeting notes found.")
 
 
+@callback_router.register(consts.GET_NOTES)
 def get_notes_callback(update, context):
     """Get meeting notes if available
 
@@ -248,7 +255,7 @@ def get_notes_callback(update, context):
     """
     query = update.callback_query
     query.answer()
-    _, meeting_id = query.data.split(",")
+    meeting_id = context.args[0]
     meeting = database.get_meeting_by_id(meeting_id)
 
     if meeting is None:
@@ -1,3 +1,5 @@
+import functools
+
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -11,16 +13,25 @@ import consts
 from db import database
 from models import Tasks
 from dojobot import utils
+from dojobot.callbacks import callback_router
+from dojobot.intents import intent_registry
+from dojobot.tokens import callback_tokens
+from dojobot.coalescer import ReplyMarkupCoalescer
+
+# Feedback keyboards are edited at most once per window under reaction bursts
+feedback_edits = ReplyMarkupCoalescer()
 
 
-def create_task_intent(context, message, intent):
+@intent_registry.register(consts.CREATE_TASK)
+def create_task_intent(update, context, intent):
     """Handle create task intent
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
         intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     task = Tasks(team_id=message.chat_id, status=consts.TASK_TODO)
     context.user_data[consts.CURR_TASK] = task
     ask_task_details(context.bot, message.chat_id, task)
@@ -79,6 +90,7 @@ def get_task_text(task):
     )
 
 
+@callback_router.register(consts.EDIT_TASK_NAME)
 def ask_task_name(update, context):
     """Ask user for the task name
 
@@ -98,6 +110,7 @@ def ask_task_name(update, context):
     utils.edit_query_message(context, query, text)
 
 
+@callback_router.register(consts.EDIT_TASK_SUMMARY)
 def ask_task_summary(update, context):
     """Ask user for the task summary
 
@@ -117,6 +130,7 @@ def ask_task_summary(update, context):
     utils.edit_query_message(context, query, text)
 
 
+@callback_router.register(consts.EDIT_TASK_STATUS)
 def ask_task_status(update, context):
     """Ask user for the task status
 
@@ -129,22 +143,29 @@ def ask_task_status(update, context):
     reply_markup = None
 
     if context.user_data.get(consts.CURR_TASK) is not None:
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    consts.TASK_TODO,
-                    callback_data=f"{consts.SET_TASK_STATUS},{consts.TASK_TODO}",
-                ),
-                InlineKeyboardButton(
-                    consts.TASK_DOING,
-                    callback_data=f"{consts.SET_TASK_STATUS},{consts.TASK_DOING}",
-                ),
-                InlineKeyboardButton(
-                    consts.TASK_DONE,
-                    callback_data=f"{consts.SET_TASK_STATUS},{consts.TASK_DONE}",
-                ),
+        with callback_tokens.batch():
+            keyboard = [
+                [
+                    InlineKeyboardButton(
+                        consts.TASK_TODO,
+                        callback_data=callback_tokens.data(
+                            consts.SET_TASK_STATUS, consts.TASK_TODO
+                        ),
+                    ),
+                    InlineKeyboardButton(
+                        consts.TASK_DOING,
+                        callback_data=callback_tokens.data(
+                            consts.SET_TASK_STATUS, consts.TASK_DOING
+                        ),
+                    ),
+                    InlineKeyboardButton(
+                        consts.TASK_DONE,
+                        callback_data=callback_tokens.data(
+                            consts.SET_TASK_STATUS, consts.TASK_DONE
+                        ),
+                    ),
+                ]
             ]
-        ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = "Please select the task status."
     else:
@@ -153,6 +174,7 @@ def ask_task_status(update, context):
     query.edit_message_text(text, reply_markup=reply_markup)
 
 
+@callback_router.register(consts.SET_TASK_STATUS)
 def task_status_callback(update, context):
     """Handle user selected a task status
 
@@ -163,7 +185,7 @@ def task_status_callback(update, context):
     query = update.callback_query
     query.answer()
     task = context.user_data.get(consts.CURR_TASK)
-    _, status = query.data.split(",")
+    status = context.args[0]
 
     if task is not None:
         task.status = status
@@ -173,6 +195,7 @@ def task_status_callback(update, context):
         query.edit_message_text("Invalid task, please try again.")
 
 
+@callback_router.register(consts.EDIT_TASK_DATE)
 def ask_task_date(update, context):
     """Ask user for the task due date
 
@@ -192,6 +215,7 @@ def ask_task_date(update, context):
     utils.edit_query_message(context, query, text)
 
 
+@callback_router.register(consts.EDIT_TASK_USER)
 def ask_task_user(update, context):
     """Ask user for the user to assign this task to
 
@@ -208,46 +232,54 @@ def ask_task_user(update, context):
         keyboard = []
         reply_markup = None
 
-        # There's only one user in private chats
-        if query.message.chat.type == Chat.PRIVATE:
-            from_user = query.from_user
-            name = from_user.first_name
-
-            if from_user.username is not None:
-                name = from_user.username
+        # The tokens of all buttons are stored at once
+        with callback_tokens.batch():
+            # There's only one user in private chats
+            if query.message.chat.type == Chat.PRIVATE:
+                from_user = query.from_user
+                name = from_user.first_name
 
-            keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        name,
-                        callback_data=f"{consts.SET_TASK_USER},{query.from_user.id}",
-                    )
-                ]
-            )
+                if from_user.username is not None:
+                    name = from_user.username
 
-        # Get all users in the group chat
-        else:
-            users = database.get_users(query.message.chat.id)
-            for user in users:
                 keyboard.append(
                     [
                         InlineKeyboardButton(
-                            user.name,
-                            callback_data=f"{consts.SET_TASK_USER},{user.user_id}",
+                            name,
+                            callback_data=callback_tokens.data(
+                                consts.SET_TASK_USER, query.from_user.id
+                            ),
                         )
                     ]
                 )
 
-        # If task has been assigned, add option to remove assignee
-        if task.user_id is not None:
-            keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        "Remove Assignee",
-                        callback_data=f"{consts.SET_TASK_USER},remove",
+            # Get all users in the group chat
+            else:
+                users = database.get_users(query.message.chat.id)
+                for user in users:
+                    keyboard.append(
+                        [
+                            InlineKeyboardButton(
+                                user.name,
+                                callback_data=callback_tokens.data(
+                                    consts.SET_TASK_USER, user.user_id
+                                ),
+                            )
+                        ]
                     )
-                ]
-            )
+
+            # If task has been assigned, add option to remove assignee
+            if task.user_id is not None:
+                keyboard.append(
+                    [
+                        InlineKeyboardButton(
+                            "Remove Assignee",
+                            callback_data=callback_tokens.data(
+                                consts.SET_TASK_USER, None
+                            ),
+                        )
+                    ]
+                )
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = "Please select the task assignee."
@@ -257,6 +289,7 @@ def ask_task_user(update, context):
     query.edit_message_text(text, reply_markup=reply_markup)
 
 
+@callback_router.register(consts.SET_TASK_USER)
 def task_user_callback(update, context):
     """Handle user selected a user to assign the task
 
@@ -266,9 +299,10 @@ def task_user_callback(update, context):
     """
     query = update.callback_query
     query.answer()
-    _, user_id = query.data.split(",")
+    user_id = context.args[0]
     task = context.user_data.get(consts.CURR_TASK)
 
+    # Legacy buttons send "remove" instead of no user
     if user_id == "remove":
         user_id = None
 
@@ -281,6 +315,7 @@ def task_user_callback(update, context):
         query.edit_message_text("Invalid task, please try again.")
 
 
+@callback_router.register(consts.CANCEL_CREATE_TASK)
 def cancel_create_task(update, context):
     """Cancel the create or update task workflow
 
@@ -296,6 +331,7 @@ def cancel_create_task(update, context):
     query.edit_message_text("What else can I do for you?")
 
 
+@callback_router.register(consts.CREATE_TASK_DONE)
 def create_task(update, context):
     """Create or update a task
 
@@ -369,13 +405,16 @@ def create_task(update, context):
             task_done_suggest(context.bot, query.message.chat.id, query.from_user.id)
 
 
-def list_tasks_intent(update, message):
+@intent_registry.register(consts.TASK_LIST)
+def list_tasks_intent(update, context, intent):
     """Handle list tasks intent
 
     Args:
         update (Update): the Telegram update object
-        message (Message): the Telegram message object
+        context (Context): the Telegram context object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     tasks = database.get_tasks(message.chat_id)
     if tasks:
         reply_markup = get_tasks_keyboard(tasks)
@@ -391,13 +430,16 @@ def list_tasks_intent(update, message):
         message.reply_text("You haven't created any tasks.")
 
 
-def list_mine_tasks_intent(update, message):
+@intent_registry.register(consts.LIST_MINE_TASK)
+def list_mine_tasks_intent(update, context, intent):
     """Handle list user assigned tasks
 
     Args:
         update (Update): the Telegram update object
-        message (Message): the Telegram message object
+        context (Context): the Telegram context object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     tasks = database.get_tasks_by_user(message.chat.id, message.from_user.id)
     if tasks:
         reply_markup = get_tasks_keyboard(tasks)
@@ -413,12 +455,16 @@ def list_mine_tasks_intent(update, message):
         message.reply_text("You don't have any assigned tasks.")
 
 
-def update_task_intent(message):
+@intent_registry.register(consts.UPDATE_TASK)
+def update_task_intent(update, context, intent):
     """Handle update task intent
 
     Args:
-        message (Message): the Telegram message object
+        update (Update): the Telegram update object
+        context (Context): the Telegram context object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     tasks = database.get_tasks(message.chat.id)
     if tasks:
         reply_markup = get_tasks_keyboard(tasks)
@@ -429,6 +475,7 @@ def update_task_intent(message):
         message.reply_text("You don't have any tasks.")
 
 
+@callback_router.register(consts.UPDATE_TASK)
 def update_task_callback(update, context):
     """User has selected a task to update, ask for the new task details
 
@@ -438,7 +485,7 @@ def update_task_callback(update, context):
     """
     query = update.callback_query
     query.answer()
-    _, task_id = query.data.split(",")
+    task_id = context.args[0]
     task = database.get_task(task_id)
 
     if task is not None:
@@ -457,16 +504,7 @@ def ask_task_feedback(bot, chat_id, task):
         chat_id (int): the chat ID
         task (Task): the Task object
     """
-    keyboard = []
-    for feeback_type, emoji in consts.FEEDBACK_TYPES.items():
-        keyboard.append(
-            InlineKeyboardButton(
-                f"{emoji} 0",
-                callback_data=f"{consts.TASK_FEEDBACK},{task.task_id},{feeback_type}",
-            )
-        )
-
-    reply_markup = InlineKeyboardMarkup([keyboard])
+    reply_markup = get_task_feedback_keyboard(task.task_id)
     bot.send_message(
         chat_id,
         text=(f"{task.user.name} has completed <b>{task.name}</b>, Great job!"),
@@ -475,6 +513,7 @@ def ask_task_feedback(bot, chat_id, task):
     )
 
 
+@callback_router.register(consts.TASK_FEEDBACK)
 def task_feedback_callback(update, context):
     """Handle user providing task feedback
 
@@ -484,26 +523,48 @@ def task_feedback_callback(update, context):
     """
     query = update.callback_query
     query.answer()
-    _, task_id, user_feedback = query.data.split(",")
+    task_id, user_feedback = context.args
     task = database.get_task(task_id)
 
     if task is not None:
         database.add_feedback(task.task_id, query.from_user.id, user_feedback)
-        keyboard = []
+        # The keyboard is edited once the feedback is committed, so it shows
+        # the new counts
+        database.after_commit(
+            functools.partial(
+                feedback_edits.submit,
+                context.bot,
+                query.message.chat.id,
+                query.message.message_id,
+                functools.partial(get_task_feedback_keyboard, task.task_id),
+            )
+        )
+
 
+def get_task_feedback_keyboard(task_id):
+    """Get the task feedback keyboard with the current feedback counts
+
+    Args:
+        task_id (int): the task ID
+
+    Returns:
+        InlineKeyboardMarkup: the task feedback keyboard
+    """
+    counts = database.get_feedback_counts([task_id])[task_id]
+    keyboard = []
+
+    with callback_tokens.batch():
         for feedback_type, emoji in consts.FEEDBACK_TYPES.items():
-            count = database.get_feedback_count(task_id, feedback_type)
             keyboard.append(
                 InlineKeyboardButton(
-                    f"{emoji} {count}",
-                    callback_data=(
-                        f"{consts.TASK_FEEDBACK},{task.task_id},{feedback_type}"
+                    f"{emoji} {counts[feedback_type]}",
+                    callback_data=callback_tokens.data(
+                        consts.TASK_FEEDBACK, task_id, feedback_type
                     ),
                 )
             )
 
-        reply_markup = InlineKeyboardMarkup([keyboard])
-        query.edit_message_reply_markup(reply_markup)
+    return InlineKeyboardMarkup([keyboard])
 
 
 def task_done_suggest(bot, chat_id, user_id):
@@ -553,14 +614,17 @@ def get_tasks_keyboard(tasks):
         InlineKeyboardMarkup: the tasks keyboard
     """
     keyboard = []
-    for task in tasks:
-        keyboard.append(
-            [
-                InlineKeyboardButton(
-                    f"{task.name} ({task.status})",
-                    callback_data=f"{consts.UPDATE_TASK},{task.task_id}",
-                )
-            ]
-        )
+    with callback_tokens.batch():
+        for task in tasks:
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        f"{task.name} ({task.status})",
+                        callback_data=callback_tokens.data(
+                            consts.UPDATE_TASK, task.task_id
+                        ),
+                    )
+                ]
+            )
 
     return InlineKeyboardMarkup(keyboard)
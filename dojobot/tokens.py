@@ -0,0 +1,163 @@
+import base64
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import arrow
+
+from db import database
+
+# Callback data starting with this is a token rather than an opcode
+TOKEN_PREFIX = "$"
+TOKEN_LENGTH = 12
+# Seconds a button keeps working for, defaults to 90 days
+TOKEN_TTL = 90 * 24 * 60 * 60
+
+
+class CallbackTokenStore:
+    """Map short callback tokens to structured button payloads
+
+    Buttons carry an opaque token instead of their opcode and arguments packed
+    into the 64 byte callback data. The token is a hash of the payload, so the
+    same button always gets the same token and keyboards that are rebuilt on
+    every press don't grow the table. Payloads are kept in a bounded in-memory
+    table in front of the database, and expire when they haven't been issued
+    for the TTL.
+
+    Tokens issued within a batch, such as the buttons of one keyboard, are
+    written to the database at once, and only kept in memory once the write
+    has been committed.
+    """
+
+    def __init__(self, size=10000, ttl=None):
+        """
+        Args:
+            size (int, optional): the number of payloads kept in memory.
+                Defaults to 10000.
+            ttl (int, optional): the seconds a token is valid for after it was
+                last issued. Defaults to CALLBACK_TOKEN_TTL or 90 days.
+        """
+        self.size = size
+        self.ttl = (
+            ttl if ttl is not None else int(os.getenv("CALLBACK_TOKEN_TTL", TOKEN_TTL))
+        )
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def batch(self):
+        """Write the tokens issued in the enclosed block to the database at
+        once when it exits, nested batches join the outermost one
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+
+        self._local.pending = {}
+        try:
+            yield
+            pending = self._local.pending
+        finally:
+            self._local.pending = None
+
+        self._store(pending)
+
+    def data(self, opcode, *args):
+        """Get the callback data of a button
+
+        Args:
+            opcode (str): the callback opcode
+            *args: the JSON serialisable handler arguments
+
+        Returns:
+            str: the callback data
+        """
+        payload = json.dumps([opcode, *args], separators=(",", ":"))
+        digest = hashlib.sha256(payload.encode()).digest()
+        token = base64.urlsafe_b64encode(digest).decode()[:TOKEN_LENGTH]
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._payloads.get(token)
+            if entry is not None:
+                self._payloads.move_to_end(token)
+
+        # Refresh the issue time once half of the TTL has passed
+        if entry is None or now - entry[1] > self.ttl / 2:
+            pending = getattr(self._local, "pending", None)
+            if pending is not None:
+                pending[token] = payload
+            else:
+                self._store({token: payload})
+
+        return f"{TOKEN_PREFIX}{token}"
+
+    def resolve(self, data):
+        """Get the payload of a token
+
+        Args:
+            data (str): the callback data with the token
+
+        Returns:
+            tuple: the opcode and the list of arguments, None if the token is
+                unknown or has expired
+        """
+        token = data.replace(TOKEN_PREFIX, "", 1)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._payloads.get(token)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._payloads.move_to_end(token)
+                payload = entry[0]
+            else:
+                entry = None
+
+        if entry is None:
+            callback_token = database.get_callback_token(
+                token, after=arrow.utcnow().shift(seconds=-self.ttl)
+            )
+            if callback_token is None:
+                return None
+
+            payload = callback_token.payload
+            issued_at = now - (arrow.utcnow() - callback_token.datetime).total_seconds()
+            self._remember(token, payload, issued_at)
+
+        opcode, *args = json.loads(payload)
+
+        return opcode, args
+
+    def _store(self, payloads):
+        if not payloads:
+            return
+
+        issued_at = time.monotonic()
+        database.add_callback_tokens(payloads, arrow.utcnow())
+
+        # Tokens of a rolled back unit of work must not resolve from memory
+        database.after_commit(
+            functools.partial(self._remember_all, payloads, issued_at)
+        )
+
+    def _remember_all(self, payloads, issued_at):
+        for token, payload in payloads.items():
+            self._remember(token, payload, issued_at)
+
+    def _remember(self, token, payload, issued_at):
+        with self._lock:
+            self._payloads[token] = (payload, issued_at)
+            self._payloads.move_to_end(token)
+
+            while len(self._payloads) > self.size:
+                self._payloads.popitem(last=False)
+
+
+callback_tokens = CallbackTokenStore()
@@ -9,15 +9,19 @@ from telegram import (
 from telegram.error import Unauthorized
 
 import consts
+from dojobot.intents import intent_registry
 
 
-def vote_intent(context, message):
+@intent_registry.register(consts.VOTE)
+def vote_intent(update, context, intent):
     """Handle the intent to create a poll
 
     Args:
+        update (Update): the Telegram update object
         context (Context): the Telegram context object
-        message (Message): the Telegram message object
+        intent (IntentResult): the intent result from Dialogflow
     """
+    message = update.effective_message
     if message.chat.type != Chat.PRIVATE:
         chat_id = message.from_user.id
         context.user_data[consts.VOTE] = message.chat.id
@@ -0,0 +1,317 @@
+import argparse
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from webhook import SECRET_TOKEN_HEADER
+
+LOGGER = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 1000,
+    "is_bot": True,
+    "first_name": "Dojo",
+    "username": "dojo_test_bot",
+}
+TEST_USER = {"id": 2000, "is_bot": False, "first_name": "Tester", "username": "tester"}
+# The bot and the test user
+NUM_CHAT_MEMBERS = 2
+
+
+def get_chat(chat_id):
+    """Build a minimal chat, negative IDs are groups like on Telegram
+
+    Args:
+        chat_id (int or str): the chat ID
+
+    Returns:
+        dict: the chat
+    """
+    chat_id = int(chat_id or TEST_USER["id"])
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": TEST_USER["first_name"]}
+
+    chat_type = "supergroup" if str(chat_id).startswith("-100") else "group"
+
+    return {"id": chat_id, "type": chat_type, "title": "Test group"}
+
+
+class FakeTelegram:
+    """Local stand-in for the Telegram Bot API to run the bot offline
+
+    Point the bot at it with TELEGRAM_API_URL and run the bot in webhook mode.
+    Bot API calls are recorded and answered with minimal results, and updates
+    are delivered to the webhook the bot registered, with its secret token.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8081):
+        """
+        Args:
+            host (str, optional): the address to listen on.
+                Defaults to "127.0.0.1".
+            port (int, optional): the port to listen on. Defaults to 8081.
+        """
+        self.calls = []
+        self.webhook_url = None
+        self.secret_token = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._poll_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    @property
+    def file_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/file/bot"
+
+    def start(self):
+        """Start the server in a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def get_calls(self, method):
+        """Get the recorded calls of a Bot API method
+
+        Args:
+            method (str): the method name, such as "sendMessage"
+
+        Returns:
+            list: the parameters of each call
+        """
+        with self._lock:
+            return [params for name, params in self.calls if name == method]
+
+    def send_update(self, update):
+        """Deliver an update to the registered webhook
+
+        Args:
+            update (dict): the update without its update ID
+
+        Returns:
+            int: the HTTP status returned by the webhook
+        """
+        if self.webhook_url is None:
+            raise RuntimeError("The bot hasn't registered a webhook")
+
+        update = {"update_id": next(self._update_ids), **update}
+        request = urllib.request.Request(
+            self.webhook_url,
+            data=json.dumps(update).encode(),
+            headers={
+                "Content-Type": "application/json",
+                SECRET_TOKEN_HEADER: self.secret_token or "",
+            },
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def send_text(self, text, chat_id=None, chat_type="private", user=None):
+        """Deliver a text message update to the registered webhook
+
+        Args:
+            text (str): the message text
+            chat_id (int, optional): the chat ID. Defaults to the user ID.
+            chat_type (str, optional): the chat type. Defaults to "private".
+            user (dict, optional): the sender. Defaults to the test user.
+
+        Returns:
+            int: the HTTP status returned by the webhook
+        """
+        user = user or TEST_USER
+        chat = {"id": chat_id or user["id"], "type": chat_type}
+        if chat_type == "private":
+            chat["first_name"] = user["first_name"]
+        else:
+            chat["title"] = "Test group"
+
+        return self.send_update(
+            {
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "from": user,
+                    "chat": chat,
+                    "date": int(time.time()),
+                    "text": text,
+                }
+            }
+        )
+
+    def handle_call(self, method, params):
+        """Record a Bot API call and build its result
+
+        Args:
+            method (str): the method name
+            params (dict): the call parameters
+
+        Returns:
+            object: the method result
+        """
+        with self._lock:
+            self.calls.append((method, params))
+
+        if method == "getMe":
+            return BOT_USER
+
+        if method == "getChat":
+            return get_chat(params.get("chat_id"))
+
+        if method in {"getChatMemberCount", "getChatMembersCount"}:
+            return NUM_CHAT_MEMBERS
+
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            user = BOT_USER if user_id == BOT_USER["id"] else TEST_USER
+            return {"user": {**user, "id": user_id or user["id"]}, "status": "member"}
+
+        if method == "getChatAdministrators":
+            return [{"user": TEST_USER, "status": "creator", "is_anonymous": False}]
+
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_path": f"voice/{file_id}.oga",
+            }
+
+        if method == "stopPoll":
+            return self._make_poll({"question": "", "options": []}, is_closed=True)
+
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.secret_token = params.get("secret_token")
+        elif method == "deleteWebhook":
+            self.webhook_url = self.secret_token = None
+        elif method == "getWebhookInfo":
+            return {
+                "url": self.webhook_url or "",
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+            }
+        elif method in {
+            "sendMessage",
+            "sendDocument",
+            "sendPoll",
+            "editMessageText",
+            "editMessageReplyMarkup",
+        }:
+            LOGGER.info("%s: %s", method, params.get("text", ""))
+            message = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "from": BOT_USER,
+                "chat": get_chat(params.get("chat_id")),
+                "date": int(time.time()),
+                "text": params.get("text", ""),
+            }
+            if method == "sendPoll":
+                message["poll"] = self._make_poll(params)
+
+            return message
+
+        return True
+
+    def _make_poll(self, params, is_closed=False):
+        options = params.get("options") or []
+        if isinstance(options, str):
+            options = json.loads(options)
+
+        return {
+            "id": str(next(self._poll_ids)),
+            "question": params.get("question", ""),
+            "options": [{"text": x, "voter_count": 0} for x in options],
+            "total_voter_count": 0,
+            "is_closed": is_closed,
+            "is_anonymous": params.get("is_anonymous", True),
+            "type": params.get("type", "regular"),
+            "allows_multiple_answers": params.get("allows_multiple_answers", False),
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class FakeTelegramHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = {}
+
+                self._respond(params)
+
+            def do_GET(self):
+                self._respond({})
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+            def _respond(self, params):
+                method = self.path.rsplit("/", 1)[-1].split("?", 1)[0]
+                result = server.handle_call(method, params)
+                content = json.dumps({"ok": True, "result": result}).encode()
+
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return FakeTelegramHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a fake Telegram server and send each input line to the "
+        "bot as a private text message"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8081, help="Port to listen on")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    fake = FakeTelegram(args.host, args.port)
+    fake.start()
+    print(
+        f"Run the bot with TELEGRAM_API_URL={fake.api_url}, "
+        f"TELEGRAM_FILE_URL={fake.file_url} and WEBHOOK_URL set"
+    )
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        if fake.webhook_url is None:
+            print("The bot hasn't registered a webhook yet")
+        else:
+            print(f"Webhook returned {fake.send_text(line.strip())}")
+
+    fake.stop()
@@ -0,0 +1,95 @@
+import functools
+import re
+import threading
+
+from telegram import Chat
+from telegram.ext import MessageFilter
+
+GROUP_TYPES = {Chat.GROUP, Chat.SUPERGROUP}
+
+
+@functools.lru_cache(maxsize=None)
+def get_mention_pattern(username):
+    """Get the compiled pattern of a mention of the bot
+
+    Args:
+        username (str): the bot username
+
+    Returns:
+        Pattern: the pattern matching the mention and the whitespaces after it
+    """
+    return re.compile(rf"@{re.escape(username)}\s*")
+
+
+def strip_mention(text, username):
+    """Remove the mentions of the bot from the text
+
+    Args:
+        text (str): the message text
+        username (str): the bot username
+
+    Returns:
+        str: the text without the mentions
+    """
+    return get_mention_pattern(username).sub("", text)
+
+
+class AddressedFilter(MessageFilter):
+    """Filter messages addressed to the bot
+
+    Private messages always pass, group messages only pass when they start
+    with a mention of the bot or reply to one of its messages. The check runs
+    before the dispatcher picks a handler, so unaddressed group traffic never
+    reaches any handler code.
+    """
+
+    def __init__(self, username, bot_id):
+        """
+        Args:
+            username (str): the bot username
+            bot_id (int): the bot user ID
+        """
+        self.mention = f"@{username}"
+        self.bot_id = bot_id
+        self.name = f"AddressedFilter({username})"
+        self.num_passed = 0
+        self.num_rejected = 0
+        self._lock = threading.Lock()
+
+    def filter(self, message):
+        is_addressed = self.is_addressed(message)
+        with self._lock:
+            if is_addressed:
+                self.num_passed += 1
+            else:
+                self.num_rejected += 1
+
+        return is_addressed
+
+    def is_addressed(self, message):
+        chat_type = message.chat.type
+        if chat_type == Chat.PRIVATE:
+            return True
+
+        if chat_type not in GROUP_TYPES:
+            return False
+
+        if message.text is not None and message.text.startswith(self.mention):
+            return True
+
+        reply = message.reply_to_message
+
+        return (
+            reply is not None
+            and reply.from_user is not None
+            and reply.from_user.id == self.bot_id
+        )
+
+    def stats(self):
+        """Get the filter statistics
+
+        Returns:
+            dict: the statistics
+        """
+        with self._lock:
+            return {"passed": self.num_passed, "rejected": self.num_rejected}
@@ -1,6 +1,10 @@
+from .callback_tokens import CallbackTokens
 from .database import Database, DB_Session
+from .engine import create_db_engine
 from .feedback import Feedback
 from .meetings import Meetings
 from .tasks import Tasks
 from .teams import Teams
+from .user_data import UserData
 from .users import Users
+from .voice_recognitions import VoiceRecognitions
@@ -0,0 +1,18 @@
+# CallbackTokens class
+# the structured payloads of inline keyboard buttons keyed by a short token
+import arrow
+
+from sqlalchemy import Column, String, Index
+from sqlalchemy_utils import ArrowType
+
+from models.base import Base
+
+
+class CallbackTokens(Base):
+    __tablename__ = "CallbackTokens"
+    __table_args__ = (Index("ix_callback_tokens_datetime", "datetime"),)
+
+    token = Column(String, primary_key=True)
+    # the JSON encoded opcode and arguments
+    payload = Column(String, nullable=False)
+    datetime = Column(ArrowType, nullable=False, default=arrow.utcnow)
@@ -2,9 +2,15 @@
 # aim to create the db and all the table
 # provide all the functionalities of insert/delete/change records
 import arrow
+import functools
+import threading
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import func, inspect, or_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import consts
 
@@ -15,35 +21,195 @@ from .users import Users
 from .tasks import Tasks
 from .notifications import Notifications
 from .feedback import Feedback
+from .voice_recognitions import VoiceRecognitions
+from .callback_tokens import CallbackTokens
+from .user_data import UserData
+from .engine import create_db_engine
 
-# create a database engine that stores data in the local directory's bot.db
+# create a database engine configured from the environment, which defaults to
+# storing data in the local directory's bot.db
 # a SQLAlchemy Engine that will interact with our sqlite database
-# a SQLAlchemy ORM session factory bound to this engine
+# a SQLAlchemy ORM thread-local session registry bound to this engine, objects
+# are kept loaded after commit as they outlive their session in user_data
 # a base class for our classes definitions.
-engine = create_engine("sqlite:///bot.db", connect_args={"check_same_thread": False})
-DB_Session = sessionmaker(bind=engine)
+engine = create_db_engine()
+DB_Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
+
+# errors of schema changes that another process starting at the same time has
+# already made
+SCHEMA_RACE_ERRORS = ("already exists", "duplicate column name")
+
+# the number of tasks and seconds to keep feedback counts in memory for
+FEEDBACK_CACHE_SIZE = 10000
+FEEDBACK_CACHE_TTL = 300
 
 
 class Database(object):
+    def __init__(self):
+        self.noti_listeners = []
+        self._local = threading.local()
+        self._feedback_counts = OrderedDict()
+        # Bumped when cached counts are invalidated, counts loaded while it
+        # changed may predate the commit and aren't cached
+        self._feedback_version = 0
+        self._feedback_lock = threading.Lock()
+
+    @contextmanager
+    def unit_of_work(self):
+        """Run all database calls of the enclosed block in one session and
+        one transaction, which is committed and closed when the block exits
+
+        Nested units of work join the outermost one. Changes committed by a
+        checkpoint stay committed when the rest of the unit of work fails.
+        """
+        if self.in_unit_of_work():
+            yield
+            return
+
+        self._local.after_commit = []
+        self._local.committed = []
+        self._local.is_failed = False
+        try:
+            yield
+            if not self._local.is_failed:
+                self.checkpoint()
+        except Exception:
+            self._local.is_failed = True
+            raise
+        finally:
+            try:
+                # Updates that never touched the database don't open a session
+                if self._local.is_failed and DB_Session.registry.has():
+                    DB_Session.rollback()
+
+                callbacks = self._local.committed
+                self._local.after_commit = self._local.committed = None
+
+                for callback in callbacks:
+                    callback()
+            finally:
+                if DB_Session.registry.has():
+                    DB_Session.remove()
+
+    def in_unit_of_work(self):
+        return getattr(self._local, "after_commit", None) is not None
+
+    def checkpoint(self):
+        """Commit the changes of the current unit of work made so far
+
+        Called before slow network calls, so the database write lock isn't held
+        while waiting on them. The rest of the unit of work runs in a new
+        transaction, nothing is committed once the unit of work has failed.
+        """
+        if not self.in_unit_of_work() or self._local.is_failed:
+            return
+
+        if DB_Session.registry.has():
+            DB_Session.commit()
+
+        self._local.committed.extend(self._local.after_commit)
+        self._local.after_commit.clear()
+
+    def mark_failed(self):
+        """Roll back the current unit of work when it exits, for errors that
+        are caught before they reach it
+        """
+        if self.in_unit_of_work():
+            self._local.is_failed = True
+
+    def after_commit(self, callback):
+        """Run the callback once the current changes have been committed
+
+        Args:
+            callback (callable): the callback function
+        """
+        if self.in_unit_of_work():
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+
+    def add_noti_listener(self, listener):
+        """Register a listener for changes to the notifications table
+
+        Args:
+            listener (object): an object implementing `notis_added(notis)` and
+                `notis_removed(noti_ids)`
+        """
+        self.noti_listeners.append(listener)
+
+    def notify_notis_added(self, notis):
+        if notis:
+            notis = [(noti.noti_id, noti.datetime, noti.chat_id) for noti in notis]
+            for listener in self.noti_listeners:
+                self.after_commit(functools.partial(listener.notis_added, notis))
+
+    def notify_notis_removed(self, noti_ids):
+        if noti_ids:
+            for listener in self.noti_listeners:
+                self.after_commit(functools.partial(listener.notis_removed, noti_ids))
+
     def create_table(self):
         Base.metadata.drop_all(engine)
         Base.metadata.create_all(engine)
 
+    def upgrade_schema(self):
+        """Create any missing tables, columns and indexes without dropping
+        existing data, it is safe to run on every start
+
+        Missing columns are added as nullable columns without a default. Shards
+        starting at the same time may upgrade the same database, changes that
+        another process made first are skipped.
+        """
+        try:
+            Base.metadata.create_all(engine)
+        except OperationalError as e:
+            if not is_schema_race(e):
+                raise
+
+            # The other process created some of the tables, create the rest
+            Base.metadata.create_all(engine)
+
+        inspector = inspect(engine)
+
+        for table in Base.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    try:
+                        engine.execute(
+                            f'ALTER TABLE "{table.name}" '
+                            f'ADD COLUMN "{column.name}" {column_type}'
+                        )
+                    except OperationalError as e:
+                        if not is_schema_race(e):
+                            raise
+
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    try:
+                        index.create(engine)
+                    except OperationalError as e:
+                        if not is_schema_race(e):
+                            raise
+
     # insert an object to db
     def insert(self, obj):
         session = DB_Session()
         session.add(obj)
-        session.commit()
+        self.commit()
 
     def delete_meeting(self, meeting_id):
         session = DB_Session()
+        notis = session.query(Notifications).filter(
+            Notifications.meeting_id == meeting_id
+        )
+        noti_ids = [noti_id for noti_id, in notis.with_entities(Notifications.noti_id)]
+        notis.delete()
         session.query(Meetings).filter(Meetings.meeting_id == meeting_id).delete()
-        session.commit()
-
-    def delete_noti(self, noti_id):
-        session = DB_Session()
-        session.query(Notifications).filter(Notifications.noti_id == noti_id).delete()
-        session.commit()
+        self.commit()
+        self.notify_notis_removed(noti_ids)
 
     def set_remind(self, meeting_id, chat_id):
         """Set meeting reminder
@@ -59,7 +225,8 @@ class Database(object):
         meeting.has_reminder = True
         notis = self.get_remind_notis(meeting, chat_id)
         session.add_all(notis)
-        session.commit()
+        self.commit()
+        self.notify_notis_added(notis)
 
     def get_remind_notis(self, meeting, chat_id):
         """Get and create meeting reminder notifications
@@ -180,12 +347,15 @@ class Database(object):
 
         # Delete all meeting notifications associated to the given
         # meeting ID and chat ID
-        session.query(Notifications).filter(
+        notis = session.query(Notifications).filter(
             Notifications.noti_type == consts.NOTI_MEETING,
             Notifications.meeting_id == meeting_id,
             Notifications.chat_id == chat_id,
-        ).delete()
-        session.commit()
+        )
+        noti_ids = [noti_id for noti_id, in notis.with_entities(Notifications.noti_id)]
+        notis.delete()
+        self.commit()
+        self.notify_notis_removed(noti_ids)
 
     def store_meeting_agenda(self, meeting_id, file_id):
         session = DB_Session()
@@ -195,7 +365,7 @@ class Database(object):
 
         if meeting is not None:
             meeting.agenda = file_id
-            session.commit()
+            self.commit()
 
     def store_meeting_notes(self, meeting_id, file_id):
         session = DB_Session()
@@ -205,11 +375,17 @@ class Database(object):
 
         if meeting is not None:
             meeting.notes = file_id
-            session.commit()
+            self.commit()
 
     def commit(self):
+        """Commit the current session, changes are only flushed within a unit
+        of work and committed at its next checkpoint or when it exits
+        """
         session = DB_Session()
-        session.commit()
+        if self.in_unit_of_work():
+            session.flush()
+        else:
+            session.commit()
 
     def flush(self):
         session = DB_Session()
@@ -245,7 +421,7 @@ class Database(object):
         if not any(x.team_id == team.team_id for x in user.teams):
             user.teams.append(team)
 
-        session.commit()
+        self.commit()
 
     def get_meetings(self, team_id=None, before=None, after=None):
         """Get all meetings from the database with filtering options
@@ -326,7 +502,7 @@ class Database(object):
         task.status = new_task.status
         task.due_date = new_task.due_date
         task.user_id = new_task.user_id
-        session.commit()
+        self.commit()
 
         return task
 
@@ -361,25 +537,115 @@ class Database(object):
         return tasks
 
     def assign_task(self, task_id, user_id):
-        task = self.session.query(Tasks).filter(Tasks.task_id == task_id).first()
+        session = DB_Session()
+        task = session.query(Tasks).filter(Tasks.task_id == task_id).first()
         task.user_id = user_id
-        self.session.commit()
+        self.commit()
 
-    def get_passed_notis(self):
+    def get_pending_notis(self):
+        """Get all notifications that haven't been sent
+
+        Returns:
+            list: list of notifications
+        """
         session = DB_Session()
+        return session.query(Notifications).all()
+
+    def claim_notis(self, noti_ids, owner, lease_expires):
+        """Claim the notifications that no other sender holds a lease on
+
+        The lease is taken with a single conditional update, so concurrent
+        senders can't both claim a notification, and each claim counts as an
+        attempt. The claim is visible to other senders once the current unit of
+        work is committed.
+
+        Args:
+            noti_ids (list): list of notification IDs
+            owner (str): the ID of the sender
+            lease_expires (Arrow): the time the lease expires at
+
+        Returns:
+            list: list of claimed notifications ordered by their due time
+        """
+        session = DB_Session()
+        session.query(Notifications).filter(
+            Notifications.noti_id.in_(noti_ids),
+            or_(
+                Notifications.lease_owner.is_(None),
+                Notifications.lease_expires < arrow.utcnow(),
+            ),
+        ).update(
+            {
+                Notifications.lease_owner: owner,
+                Notifications.lease_expires: lease_expires,
+                Notifications.attempts: func.coalesce(Notifications.attempts, 0) + 1,
+            },
+            synchronize_session=False,
+        )
+        self.commit()
+
         return (
             session.query(Notifications)
-            .filter(Notifications.datetime < arrow.utcnow())
+            .filter(
+                Notifications.noti_id.in_(noti_ids),
+                Notifications.lease_owner == owner,
+            )
+            .order_by(Notifications.datetime)
+            .all()
+        )
+
+    def ack_notis(self, noti_ids, owner):
+        """Delete sent notifications that the sender still holds the lease on
+
+        Args:
+            noti_ids (list): list of notification IDs
+            owner (str): the ID of the sender
+        """
+        if not noti_ids:
+            return
+
+        session = DB_Session()
+        session.query(Notifications).filter(
+            Notifications.noti_id.in_(noti_ids), Notifications.lease_owner == owner
+        ).delete(synchronize_session=False)
+        self.commit()
+        self.notify_notis_removed(noti_ids)
+
+    def get_unclaimed_notis(self, due_before):
+        """Get notifications that are overdue and not held by any sender,
+        either because their sender stopped before sending them or they were
+        never scheduled
+
+        Args:
+            due_before (Arrow): the due time the notifications are overdue at
+
+        Returns:
+            list: list of notifications ordered by their due time
+        """
+        session = DB_Session()
+        return (
+            session.query(Notifications)
+            .filter(
+                Notifications.datetime < due_before,
+                or_(
+                    Notifications.lease_owner.is_(None),
+                    Notifications.lease_expires < arrow.utcnow(),
+                ),
+            )
+            .order_by(Notifications.datetime)
             .all()
         )
 
     def add_feedback(self, task_id, user_id, feedback_type):
+        task_id = int(task_id)
+        feedback_type = int(feedback_type)
         session = DB_Session()
         feedback = (
             session.query(Feedback)
             .filter(Feedback.task_id == task_id, Feedback.user_id == user_id)
             .first()
         )
+        old_type = None
 
         if feedback is None:
             feedback = Feedback(
@@ -387,16 +653,228 @@ class Database(object):
             )
             session.add(feedback)
         else:
+            old_type = feedback.feedback_type
             feedback.feedback_type = feedback_type
 
-        session.commit()
+        self.commit()
+
+        # Other threads must not see the counts change before the commit
+        if old_type != feedback_type:
+            self.after_commit(
+                functools.partial(self.invalidate_feedback_counts, task_id)
+            )
 
     def get_feedback_count(self, task_id, feedback_type):
-        return (
-            DB_Session()
-            .query(Feedback)
-            .filter(
-                Feedback.task_id == task_id, Feedback.feedback_type == feedback_type
+        return self.get_feedback_counts([task_id])[int(task_id)][int(feedback_type)]
+
+    def get_feedback_counts(self, task_ids):
+        """Get the number of each type of feedback for the given tasks, counts
+        are served from memory and loaded with one grouped query on a miss
+
+        Args:
+            task_ids (list): list of task IDs
+
+        Returns:
+            dict: the feedback counts of each task
+                {task_id: {feedback_type: count}}
+        """
+        task_ids = {int(task_id) for task_id in task_ids}
+        now = time.monotonic()
+        results = {}
+
+        with self._feedback_lock:
+            version = self._feedback_version
+            for task_id in task_ids:
+                entry = self._feedback_counts.get(task_id)
+                if entry is not None and now - entry[1] < FEEDBACK_CACHE_TTL:
+                    self._feedback_counts.move_to_end(task_id)
+                    results[task_id] = dict(entry[0])
+
+        missing = task_ids - results.keys()
+        if missing:
+            for task_id in missing:
+                results[task_id] = {x: 0 for x in consts.FEEDBACK_TYPES}
+
+            rows = (
+                DB_Session()
+                .query(Feedback.task_id, Feedback.feedback_type, func.count())
+                .filter(Feedback.task_id.in_(missing))
+                .group_by(Feedback.task_id, Feedback.feedback_type)
             )
-            .count()
+            for task_id, feedback_type, count in rows:
+                results[task_id][feedback_type] = count
+
+            with self._feedback_lock:
+                if version == self._feedback_version:
+                    for task_id in missing:
+                        self._feedback_counts[task_id] = (dict(results[task_id]), now)
+                        self._feedback_counts.move_to_end(task_id)
+
+                while len(self._feedback_counts) > FEEDBACK_CACHE_SIZE:
+                    self._feedback_counts.popitem(last=False)
+
+        return results
+
+    def invalidate_feedback_counts(self, task_id):
+        """Drop the cached feedback counts of a task after its feedback changed
+
+        Args:
+            task_id (int): the task ID
+        """
+        with self._feedback_lock:
+            self._feedback_version += 1
+            self._feedback_counts.pop(task_id, None)
+
+    def get_voice_recognition(self, file_unique_id=None, audio_hash=None, after=None):
+        """Get a recognised voice message by its file or audio content
+
+        Args:
+            file_unique_id (str, optional): the Telegram file unique ID.
+                Defaults to None.
+            audio_hash (str, optional): the hash of the voice message audio.
+                Defaults to None.
+            after (Arrow, optional): ignore recognitions older than this.
+                Defaults to None.
+
+        Returns:
+            VoiceRecognitions: the voice recognition, None if not found
+        """
+        session = DB_Session()
+        query = session.query(VoiceRecognitions)
+
+        if file_unique_id is not None:
+            query = query.filter(VoiceRecognitions.file_unique_id == file_unique_id)
+        elif audio_hash is not None:
+            query = query.filter(VoiceRecognitions.audio_hash == audio_hash)
+        else:
+            return None
+
+        if after is not None:
+            query = query.filter(VoiceRecognitions.datetime > after)
+
+        return query.first()
+
+    def add_voice_recognition(self, recognition):
+        """Store a recognised voice message, replacing any previous recognition
+        of the same file
+
+        Args:
+            recognition (VoiceRecognitions): the voice recognition
+        """
+        session = DB_Session()
+        session.merge(recognition)
+        self.commit()
+
+    def delete_voice_recognitions(self, before):
+        """Delete voice recognitions older than the given datetime
+
+        Args:
+            before (Arrow): the datetime
+        """
+        session = DB_Session()
+        session.query(VoiceRecognitions).filter(
+            VoiceRecognitions.datetime < before
+        ).delete(synchronize_session=False)
+        self.commit()
+
+    def get_callback_token(self, token, after=None):
+        """Get a callback token
+
+        Args:
+            token (str): the token
+            after (Arrow, optional): ignore tokens issued before this.
+                Defaults to None.
+
+        Returns:
+            CallbackTokens: the callback token, None if not found
+        """
+        session = DB_Session()
+        query = session.query(CallbackTokens).filter(CallbackTokens.token == token)
+        if after is not None:
+            query = query.filter(CallbackTokens.datetime > after)
+
+        return query.first()
+
+    def add_callback_tokens(self, payloads, issued_at):
+        """Store callback tokens, refreshing the issue time of existing ones
+
+        The same button issued by several chat workers or shards at once maps
+        to the same token, so tokens that already exist are ignored instead of
+        failing the insert.
+
+        Args:
+            payloads (dict): the payloads by token
+            issued_at (Arrow): the issue time
+        """
+        session = DB_Session()
+        session.execute(
+            CallbackTokens.__table__.insert().prefix_with("OR IGNORE"),
+            [
+                {"token": token, "payload": payload, "datetime": issued_at}
+                for token, payload in payloads.items()
+            ],
+        )
+        session.query(CallbackTokens).filter(
+            CallbackTokens.token.in_(list(payloads))
+        ).update({CallbackTokens.datetime: issued_at}, synchronize_session=False)
+        self.commit()
+
+    def delete_callback_tokens(self, before):
+        """Delete callback tokens issued before the given datetime
+
+        Args:
+            before (Arrow): the datetime
+        """
+        session = DB_Session()
+        session.query(CallbackTokens).filter(CallbackTokens.datetime < before).delete(
+            synchronize_session=False
         )
+        self.commit()
+
+    def get_user_data(self, user_id):
+        """Get the pickled conversation state of a user
+
+        Args:
+            user_id (int): the user ID
+
+        Returns:
+            bytes: the pickled user data, None if the user has none
+        """
+        session = DB_Session()
+        row = session.query(UserData.data).filter(UserData.user_id == user_id).first()
+
+        return None if row is None else row.data
+
+    def set_user_data(self, user_id, data):
+        """Store the pickled conversation state of a user, replacing the stored
+        one as the user may have been handled by another process since
+
+        Args:
+            user_id (int): the user ID
+            data (bytes): the pickled user data, None to delete it
+        """
+        session = DB_Session()
+        if data is None:
+            session.query(UserData).filter(UserData.user_id == user_id).delete(
+                synchronize_session=False
+            )
+        else:
+            session.execute(
+                UserData.__table__.insert().prefix_with("OR REPLACE"),
+                {"user_id": user_id, "data": data, "datetime": arrow.utcnow()},
+            )
+
+        self.commit()
+
+
+def is_schema_race(error):
+    """Check if a schema change failed because it had already been made
+
+    Args:
+        error (OperationalError): the database error
+
+    Returns:
+        bool: whether the table, column or index already exists
+    """
+    message = str(error.orig).lower()
+    return any(x in message for x in SCHEMA_RACE_ERRORS)
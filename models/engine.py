@@ -0,0 +1,231 @@
+# The database engine factory
+# reads the database URL and pool settings from the environment and
+# tunes every SQLite connection for concurrent readers and writers
+import itertools
+import os
+import sqlite3
+import threading
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+load_dotenv()
+
+DEFAULT_DATABASE_URL = "sqlite:///bot.db"
+MEMORY_DATABASE_URL = "sqlite://"
+
+# Names of the shared in-memory databases, each engine gets its own
+_memory_names = itertools.count(1)
+# Connections that keep the shared in-memory databases alive
+_memory_keepers = []
+
+
+def get_sqlite_pragmas():
+    """Get the SQLite pragmas applied on each connection
+
+    Returns:
+        dict: the pragma names and values
+    """
+    return {
+        # Readers don't block writers and writers don't block readers
+        "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+        # Only fsync at checkpoints, safe from corruption in WAL mode
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        # Negative values are in KiB
+        "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64 * 1024)),
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),
+        "temp_store": "MEMORY",
+    }
+
+
+def is_memory_database(url):
+    """Check if the database URL is an in-memory SQLite database
+
+    Args:
+        url (URL): the database URL
+
+    Returns:
+        bool: whether the database only lives in memory
+    """
+    if url.get_backend_name() != "sqlite":
+        return False
+
+    return url.database in (None, "", ":memory:") or url.query.get("mode") == "memory"
+
+
+def get_shared_memory_url(url):
+    """Get the URL of an in-memory database that all connections share
+
+    Args:
+        url (URL): the in-memory database URL
+
+    Returns:
+        URL: the URL of a shared cache in-memory database
+    """
+    if url.query.get("mode") == "memory":
+        return url
+
+    name = f"dojobot_memory_{os.getpid()}_{next(_memory_names)}"
+
+    return make_url(f"sqlite:///file:{name}?mode=memory&cache=shared&uri=true")
+
+
+def create_db_engine(url=None):
+    """Create the database engine
+
+    The URL defaults to the DATABASE_URL environment variable or the local
+    bot.db file, use "sqlite://" for an in-memory database. An in-memory
+    database is opened in shared cache mode so the pooled connections see the
+    same data, and its write transactions wait for each other like those of a
+    file database. The pool is configured by DB_POOL_SIZE, DB_MAX_OVERFLOW and
+    DB_POOL_TIMEOUT, and the SQLite tuning profile can be turned off with
+    SQLITE_TUNING=0.
+
+    Args:
+        url (str, optional): the database URL. Defaults to None.
+
+    Returns:
+        Engine: the SQLAlchemy engine
+    """
+    url = make_url(url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL))
+    kwargs = {"echo": os.getenv("DB_ECHO") == "1"}
+
+    if url.get_backend_name() == "sqlite":
+        # Sessions are shared across dispatcher worker threads
+        kwargs["connect_args"] = {"check_same_thread": False}
+        is_memory = is_memory_database(url)
+        if is_memory:
+            url = get_shared_memory_url(url)
+            kwargs["connect_args"]["factory"] = get_serialised_connection_class(
+                int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)) / 1000
+            )
+
+        kwargs["poolclass"] = QueuePool
+        kwargs["pool_size"] = int(os.getenv("DB_POOL_SIZE", 5))
+        kwargs["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", 10))
+        kwargs["pool_timeout"] = int(os.getenv("DB_POOL_TIMEOUT", 30))
+
+        engine = create_engine(url, **kwargs)
+        if is_memory:
+            # A shared in-memory database is dropped with its last connection
+            query = "&".join(f"{k}={v}" for k, v in url.query.items() if k != "uri")
+            _memory_keepers.append(
+                sqlite3.connect(
+                    f"{url.database}?{query}", uri=True, check_same_thread=False
+                )
+            )
+
+        if os.getenv("SQLITE_TUNING", "1") == "1":
+            set_sqlite_pragmas(engine, is_memory)
+        elif is_memory:
+            event.listen(engine, "connect", set_read_uncommitted)
+    else:
+        kwargs["pool_size"] = int(os.getenv("DB_POOL_SIZE", 5))
+        kwargs["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", 10))
+        kwargs["pool_timeout"] = int(os.getenv("DB_POOL_TIMEOUT", 30))
+        kwargs["pool_pre_ping"] = True
+        engine = create_engine(url, **kwargs)
+
+    return engine
+
+
+def set_sqlite_pragmas(engine, is_memory=False):
+    """Apply the SQLite tuning profile on each new connection
+
+    Args:
+        engine (Engine): the SQLAlchemy engine
+        is_memory (bool, optional): whether it is an in-memory database.
+            Defaults to False.
+    """
+    pragmas = get_sqlite_pragmas()
+
+    # Journal and memory mapping settings don't apply to in-memory databases
+    if is_memory:
+        del pragmas["journal_mode"]
+        del pragmas["mmap_size"]
+        pragmas["read_uncommitted"] = 1
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+
+        cursor.close()
+
+
+def set_read_uncommitted(dbapi_connection, connection_record):
+    """Stop readers of a shared cache database from taking table locks, which
+    fail right away instead of waiting when a writer holds the table
+    """
+    dbapi_connection.execute("PRAGMA read_uncommitted=1")
+
+
+def get_serialised_connection_class(timeout):
+    """Get a SQLite connection class whose write transactions run one at a time
+
+    Connections sharing a cache fail right away when another one is writing
+    instead of waiting for the busy timeout, so a connection waits for a shared
+    lock from its first write until its transaction ends, like writers of a
+    file database wait for its write lock.
+
+    Args:
+        timeout (float): the seconds to wait for the lock
+
+    Returns:
+        type: the connection class, passed to sqlite3.connect as the factory
+    """
+    lock = threading.Lock()
+
+    class SerialisedCursor(sqlite3.Cursor):
+        def execute(self, sql, *args):
+            self.connection.start_write(sql)
+            return super().execute(sql, *args)
+
+        def executemany(self, sql, *args):
+            self.connection.start_write(sql)
+            return super().executemany(sql, *args)
+
+    class SerialisedConnection(sqlite3.Connection):
+        is_writing = False
+
+        def cursor(self, factory=SerialisedCursor):
+            return super().cursor(factory)
+
+        def start_write(self, sql):
+            if self.is_writing or sql.lstrip()[:6].upper() in ("SELECT", "PRAGMA"):
+                return
+
+            if not lock.acquire(timeout=timeout):
+                raise sqlite3.OperationalError("database is locked")
+
+            self.is_writing = True
+
+        def end_write(self):
+            if self.is_writing:
+                self.is_writing = False
+                lock.release()
+
+        # The lock is only released once the transaction has really ended
+        def commit(self):
+            try:
+                super().commit()
+            finally:
+                self.end_write()
+
+        def rollback(self):
+            try:
+                super().rollback()
+            finally:
+                self.end_write()
+
+        def close(self):
+            try:
+                super().close()
+            finally:
+                self.end_write()
+
+    return SerialisedConnection
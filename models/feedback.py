@@ -1,13 +1,17 @@
 # Feedback class
 # M to 1 to Users amnd Tasks
 
-from sqlalchemy import Column, Integer, ForeignKey
+from sqlalchemy import Column, Integer, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from models.base import Base
 
 
 class Feedback(Base):
     __tablename__ = "Feedback"
+    __table_args__ = (
+        Index("ix_feedback_task_type", "task_id", "feedback_type"),
+        Index("ix_feedback_task_user", "task_id", "user_id"),
+    )
 
     feedback_id = Column(Integer, primary_key=True)
     feedback_type = Column(Integer, nullable=False)
@@ -2,7 +2,7 @@
 # M to 1 Teams
 import arrow
 
-from sqlalchemy import Column, String, Integer, Boolean, ForeignKey
+from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import ArrowType
 
@@ -12,6 +12,7 @@ from models.base import Base
 
 class Meetings(Base):
     __tablename__ = "Meetings"
+    __table_args__ = (Index("ix_meetings_team_datetime", "teams_id", "datetime"),)
 
     meeting_id = Column(Integer, primary_key=True)
     # changed datetime, added duration
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, ForeignKey, Index
 from sqlalchemy_utils import ArrowType
 
 from models.base import Base
@@ -6,6 +6,11 @@ from models.base import Base
 
 class Notifications(Base):
     __tablename__ = "Notifications"
+    __table_args__ = (
+        Index("ix_notifications_datetime", "datetime"),
+        Index("ix_notifications_meeting", "meeting_id", "chat_id"),
+        Index("ix_notifications_lease", "lease_expires"),
+    )
 
     noti_id = Column(Integer, primary_key=True)
     noti_type = Column(Integer, nullable=False)
@@ -15,3 +20,9 @@ class Notifications(Base):
     text = Column(String, nullable=False)
     doc_id = Column(String)
     doc_caption = Column(String)
+    # The sender that claimed the notification and until when, it is deleted
+    # once sent and claimed again by another sender if the lease expires
+    lease_owner = Column(String)
+    lease_expires = Column(ArrowType)
+    # The number of times the notification has been claimed for sending
+    attempts = Column(Integer)
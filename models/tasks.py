@@ -3,7 +3,7 @@
 
 import arrow
 
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import ArrowType
 
@@ -14,6 +14,10 @@ from models.base import Base
 
 class Tasks(Base):
     __tablename__ = "Tasks"
+    __table_args__ = (
+        Index("ix_tasks_team_status", "team_id", "status"),
+        Index("ix_tasks_team_user_status", "team_id", "user_id", "status"),
+    )
 
     task_id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
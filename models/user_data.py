@@ -0,0 +1,16 @@
+# UserData class
+# the pickled conversation state of each user, shared by all bot processes
+import arrow
+
+from sqlalchemy import Column, Integer, LargeBinary
+from sqlalchemy_utils import ArrowType
+
+from models.base import Base
+
+
+class UserData(Base):
+    __tablename__ = "UserData"
+
+    user_id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    datetime = Column(ArrowType, nullable=False, default=arrow.utcnow)
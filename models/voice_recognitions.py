@@ -0,0 +1,24 @@
+# VoiceRecognitions class
+# recognised voice messages keyed by their Telegram file_unique_id
+import arrow
+
+from sqlalchemy import Column, String, Boolean, Index
+from sqlalchemy_utils import ArrowType
+
+from models.base import Base
+
+
+class VoiceRecognitions(Base):
+    __tablename__ = "VoiceRecognitions"
+    __table_args__ = (Index("ix_voice_recognitions_audio_hash", "audio_hash"),)
+
+    file_unique_id = Column(String, primary_key=True)
+    audio_hash = Column(String, nullable=False)
+    query_text = Column(String, nullable=False)
+    intent = Column(String, nullable=False)
+    fulfill_text = Column(String)
+    is_mentioned = Column(Boolean, nullable=False)
+    # whether the query text must be sent to the NLU again instead of reusing
+    # the intent, as it has date parameters or depends on the conversation
+    needs_replay = Column(Boolean, nullable=False)
+    datetime = Column(ArrowType, nullable=False, default=arrow.utcnow)
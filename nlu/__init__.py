@@ -0,0 +1,28 @@
+import os
+
+from dotenv import load_dotenv
+
+from .intent import IntentResult  # noqa
+from .classifier import PhraseClassifier, normalise  # noqa
+from .date_parser import parse_date  # noqa
+from .backends import (  # noqa
+    LocalBackend,
+    NLUBackend,
+    RecordingBackend,
+    ReplayBackend,
+)
+from .cache import IntentCache, is_cacheable  # noqa
+from .executor import CircuitBreaker, NLUExecutor  # noqa
+
+load_dotenv()
+
+phrase_classifier = PhraseClassifier()
+nlu_executor = NLUExecutor(
+    workers=int(os.getenv("NLU_WORKERS", 8)),
+    max_pending=int(os.getenv("NLU_QUEUE_SIZE", 32)),
+    deadline=float(os.getenv("NLU_DEADLINE", 5)),
+)
+intent_cache = IntentCache(
+    size=int(os.getenv("INTENT_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("INTENT_CACHE_TTL", 600)),
+)
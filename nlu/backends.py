@@ -0,0 +1,230 @@
+import abc
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from google.api_core import exceptions
+
+import consts
+from nlu.classifier import PhraseClassifier, normalise
+from nlu.date_parser import parse_date
+from nlu.intent import IntentResult
+
+LOGGER = logging.getLogger(__name__)
+
+FALLBACK_INTENT = "Default Fallback Intent"
+FALLBACK_TEXT = "Sorry, I didn't get that. Type /help to see what I can do."
+WAKE_PHRASE = f"hey {consts.BOT_NAME.lower()}"
+
+
+def request_key(text=None, input_audio=None):
+    """Get the key identifying an NLU request for recording and replaying
+
+    Args:
+        text (str, optional): the text. Defaults to None.
+        input_audio (bytes, optional): the audio. Defaults to None.
+
+    Returns:
+        str: the normalised text, or the hash of the audio
+    """
+    if text is not None:
+        return f"text:{normalise(text)}"
+
+    return f"audio:{hashlib.sha256(input_audio).hexdigest()}"
+
+
+class NLUBackend(abc.ABC):
+    """Base class of the NLU backends
+
+    A backend detects the intent of a text or audio query and returns an
+    IntentResult, subclasses implement get_intent.
+    """
+
+    @abc.abstractmethod
+    def get_intent(
+        self,
+        session_id,
+        text=None,
+        input_audio=None,
+        audio_encoding="LINEAR16",
+        sample_rate=None,
+        timeout=None,
+    ):
+        """Get intent from a given text or audio
+
+        Args:
+            session_id (str): the session ID allows continuation of a conversation
+            text (str): the text for getting its intent
+            input_audio (bytes): the audio for getting its intent
+            audio_encoding (str): the audio encoding, LINEAR16 or OGG_OPUS
+            sample_rate (int): the audio sample rate, required for raw audio
+            timeout (float): the request timeout in seconds
+
+        Returns:
+            IntentResult: the intent result
+        """
+
+    def close(self):
+        """Release any resources held by the backend"""
+
+
+class LocalBackend(NLUBackend):
+    """Rule based backend that runs without any external service
+
+    Fixed phrases are matched by the phrase classifier and dates by the date
+    parser, anything else gets the fallback intent. Audio can't be recognised
+    locally so it always gets the fallback intent, without a query text so the
+    voice cache doesn't store it.
+    """
+
+    def __init__(self, classifier=None):
+        """
+        Args:
+            classifier (PhraseClassifier, optional): the phrase classifier.
+                Defaults to None, which creates one with the default phrases.
+        """
+        self.classifier = classifier or PhraseClassifier()
+
+    def get_intent(
+        self,
+        session_id,
+        text=None,
+        input_audio=None,
+        audio_encoding="LINEAR16",
+        sample_rate=None,
+        timeout=None,
+    ):
+        if text is None:
+            return IntentResult(FALLBACK_INTENT, None, True, FALLBACK_TEXT, False)
+
+        query = normalise(text)
+        is_mentioned = query.startswith(WAKE_PHRASE)
+        if is_mentioned:
+            query = query.replace(WAKE_PHRASE, "", 1).strip()
+
+        intent = self.classifier.classify(query)
+        if intent is None:
+            date = parse_date(query)
+            if date is not None:
+                intent = IntentResult(
+                    consts.DATE_INTENT, {"datetime": date}, True, "", False
+                )
+            else:
+                intent = IntentResult(FALLBACK_INTENT, None, True, FALLBACK_TEXT, False)
+
+        intent.is_mentioned = is_mentioned
+        intent.query_text = text
+
+        return intent
+
+
+class ReplayBackend(NLUBackend):
+    """Serve recorded responses from disk with a simulated latency
+
+    Responses are read from a JSON lines file written by RecordingBackend, so
+    handler benchmarks can run offline and reproducibly. Requests that weren't
+    recorded get the fallback intent. The file is loaded on the first request,
+    if it doesn't exist every request gets the fallback intent.
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        Args:
+            path (str): the path to the recorded responses
+            latency (float, optional): the seconds each request takes.
+                Defaults to 0.
+        """
+        self.path = path
+        self.latency = latency
+        self.num_hits = 0
+        self.num_misses = 0
+        self._responses = None
+        self._lock = threading.Lock()
+
+    def get_intent(
+        self,
+        session_id,
+        text=None,
+        input_audio=None,
+        audio_encoding="LINEAR16",
+        sample_rate=None,
+        timeout=None,
+    ):
+        if timeout is not None and timeout < self.latency:
+            time.sleep(timeout)
+            raise exceptions.DeadlineExceeded("Replayed request timed out")
+
+        time.sleep(self.latency)
+        result = self._get_responses().get(request_key(text, input_audio))
+
+        with self._lock:
+            if result is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+
+        if result is None:
+            return IntentResult(FALLBACK_INTENT, None, True, FALLBACK_TEXT, False, text)
+
+        return IntentResult.from_dict(result)
+
+    def stats(self):
+        """Get the replay statistics
+
+        Returns:
+            dict: the statistics
+        """
+        with self._lock:
+            return {"hits": self.num_hits, "misses": self.num_misses}
+
+    def _get_responses(self):
+        with self._lock:
+            if self._responses is not None:
+                return self._responses
+
+            self._responses = {}
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        if line.strip():
+                            record = json.loads(line)
+                            self._responses[record["key"]] = record["result"]
+            except FileNotFoundError:
+                LOGGER.error(
+                    "NLU replay file %s doesn't exist, record one by setting "
+                    "NLU_RECORD_FILE with the dialogflow backend",
+                    self.path,
+                )
+
+            return self._responses
+
+
+class RecordingBackend(NLUBackend):
+    """Record the responses of another backend for ReplayBackend"""
+
+    def __init__(self, backend, path):
+        """
+        Args:
+            backend (NLUBackend): the backend to record
+            path (str): the path to append the recorded responses to
+        """
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get_intent(self, session_id, text=None, input_audio=None, **kwargs):
+        result = self.backend.get_intent(
+            session_id, text=text, input_audio=input_audio, **kwargs
+        )
+        record = {"key": request_key(text, input_audio), "result": result.to_dict()}
+
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        return result
+
+    def close(self):
+        self.backend.close()
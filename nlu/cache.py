@@ -0,0 +1,142 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+import consts
+from nlu.classifier import LATENCY_SMOOTHING, normalise
+from nlu.intent import IntentResult
+
+# Intents that mean the same whoever sends them and whenever they are sent,
+# they don't take part in a Dialogflow conversation and have no parameters
+# that are relative to the current time
+CACHEABLE_INTENTS = {
+    consts.CREATE_TASK,
+    consts.UPDATE_TASK,
+    consts.TASK_LIST,
+    consts.LIST_MINE_TASK,
+    consts.MEETING_LIST,
+    consts.VOTE,
+    consts.STORE_AGENDA,
+    consts.GET_AGENDA,
+    consts.STORE_NOTES,
+    consts.GET_NOTES,
+    consts.CHANGE_REMIND,
+    consts.CANCEL_MEETING,
+}
+
+
+def is_cacheable(intent):
+    """Check if an intent result can be reused for the same text
+
+    Args:
+        intent (IntentResult): the intent result
+
+    Returns:
+        bool: whether it is context free and has no date parameters
+    """
+    if intent.intent not in CACHEABLE_INTENTS:
+        return False
+
+    # Dates such as "tomorrow" are resolved against the time of the request
+    return intent.params is None or all(x is None for x in intent.params.values())
+
+
+class IntentCache:
+    """TTL cache of intent results for repeated identical texts
+
+    Results are keyed by the normalised text and language, so the same short
+    command from different users only needs one NLU request.
+    """
+
+    def __init__(self, size=1000, ttl=600):
+        """
+        Args:
+            size (int, optional): the maximum number of results. Defaults to 1000.
+            ttl (float, optional): the seconds to keep a result for.
+                Defaults to 600.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.num_hits = 0
+        self.num_misses = 0
+        self.remote_latency = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text, language="en"):
+        """Get the cached intent result of the text
+
+        Args:
+            text (str): the text
+            language (str, optional): the language code. Defaults to "en".
+
+        Returns:
+            IntentResult: a copy of the intent result, None if not cached
+        """
+        key = (language, normalise(text))
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.num_hits += 1
+                result = IntentResult.from_dict(entry[0])
+                result.query_text = text
+
+                return result
+
+            if entry is not None:
+                del self._entries[key]
+
+            self.num_misses += 1
+
+        return None
+
+    def add(self, text, intent, latency=None, language="en"):
+        """Cache the intent result of the text if it is cacheable
+
+        Args:
+            text (str): the text
+            intent (IntentResult): the intent result
+            latency (float, optional): the seconds the NLU request took.
+                Defaults to None.
+            language (str, optional): the language code. Defaults to "en".
+        """
+        with self._lock:
+            if latency is not None:
+                if self.remote_latency is None:
+                    self.remote_latency = latency
+                else:
+                    self.remote_latency += LATENCY_SMOOTHING * (
+                        latency - self.remote_latency
+                    )
+
+            if not is_cacheable(intent):
+                return
+
+            key = (language, normalise(text))
+            self._entries[key] = (intent.to_dict(), time.monotonic())
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Get the hit rate statistics
+
+        Returns:
+            dict: the statistics, the saved latency is estimated from the
+                average NLU latency
+        """
+        with self._lock:
+            total = self.num_hits + self.num_misses
+            return {
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits / total if total else 0.0,
+                "size": len(self._entries),
+                "remote_latency": self.remote_latency,
+                "latency_saved": self.num_hits * (self.remote_latency or 0.0),
+            }
@@ -0,0 +1,170 @@
+import re
+import threading
+import time
+
+import consts
+from nlu.intent import IntentResult
+
+# Intents that take an optional meeting datetime, without one the handlers
+# ask the user to pick a meeting
+DATETIME_INTENTS = {
+    consts.STORE_AGENDA,
+    consts.GET_AGENDA,
+    consts.STORE_NOTES,
+    consts.GET_NOTES,
+    consts.CHANGE_REMIND,
+    consts.CANCEL_MEETING,
+}
+
+# Phrases mapped to their intent, along with the user_data key that must be
+# present for the phrase to mean that intent. Phrases that start a Dialogflow
+# slot filling conversation, such as "schedule meeting", are left to Dialogflow.
+PHRASES = {
+    "create task": (consts.CREATE_TASK, None),
+    "new task": (consts.CREATE_TASK, None),
+    "add task": (consts.CREATE_TASK, None),
+    "list tasks": (consts.TASK_LIST, None),
+    "show tasks": (consts.TASK_LIST, None),
+    "tasks": (consts.TASK_LIST, None),
+    "list my tasks": (consts.LIST_MINE_TASK, None),
+    "show my tasks": (consts.LIST_MINE_TASK, None),
+    "my tasks": (consts.LIST_MINE_TASK, None),
+    "update task": (consts.UPDATE_TASK, None),
+    "edit task": (consts.UPDATE_TASK, None),
+    "list meetings": (consts.MEETING_LIST, None),
+    "show meetings": (consts.MEETING_LIST, None),
+    "upcoming meetings": (consts.MEETING_LIST, None),
+    "create poll": (consts.VOTE, None),
+    "store agenda": (consts.STORE_AGENDA, None),
+    "upload agenda": (consts.STORE_AGENDA, None),
+    "get agenda": (consts.GET_AGENDA, None),
+    "store notes": (consts.STORE_NOTES, None),
+    "upload notes": (consts.STORE_NOTES, None),
+    "get notes": (consts.GET_NOTES, None),
+    "cancel meeting": (consts.CANCEL_MEETING, None),
+    "change reminder": (consts.CHANGE_REMIND, None),
+    "yes": (consts.MEETING_REMINDER, consts.SCHEDULE_MEETING),
+    "no": (consts.MEETING_NO_REMIDNER, consts.SCHEDULE_MEETING),
+}
+
+FULFILL_TEXTS = {consts.MEETING_LIST: "Here are your upcoming meetings:"}
+
+# Weight of the latest Dialogflow latency in its moving average
+LATENCY_SMOOTHING = 0.1
+
+
+def normalise(text):
+    """Normalise text for phrase matching
+
+    Args:
+        text (str): the text
+
+    Returns:
+        str: the lower case text without punctuation and extra whitespaces
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+class PhraseClassifier:
+    """Deterministic classifier for high confidence phrases
+
+    Reply keyboard texts and other fixed phrases are mapped to their intent
+    locally, anything else falls back to Dialogflow.
+    """
+
+    def __init__(self, phrases=PHRASES):
+        """
+        Args:
+            phrases (dict, optional): the phrases mapped to their intent and
+                required user_data key. Defaults to PHRASES.
+        """
+        self.phrases = {normalise(x): y for x, y in phrases.items()}
+        self.num_hits = 0
+        self.num_misses = 0
+        self.intent_hits = {}
+        self.remote_latency = None
+        self._lock = threading.Lock()
+
+    def classify(self, text, user_data=None):
+        """Classify the text locally
+
+        Args:
+            text (str): the text to classify
+            user_data (dict, optional): the Telegram user data. Defaults to None.
+
+        Returns:
+            IntentResult: the intent result, None if the text isn't recognised
+        """
+        match = self.phrases.get(normalise(text))
+        if match is None:
+            return None
+
+        intent, required_key = match
+        if required_key is not None and (
+            user_data is None or required_key not in user_data
+        ):
+            return None
+
+        params = None
+        all_params_present = True
+        if intent in DATETIME_INTENTS:
+            params = {"datetime": None}
+            all_params_present = False
+
+        return IntentResult(
+            intent, params, all_params_present, FULFILL_TEXTS.get(intent, ""), False
+        )
+
+    def resolve(self, text, user_data, fallback):
+        """Classify the text locally or fall back to the given NLU call
+
+        Args:
+            text (str): the text to classify
+            user_data (dict): the Telegram user data
+            fallback (callable): called with the text if it isn't recognised
+
+        Returns:
+            IntentResult: the intent result
+        """
+        intent = self.classify(text, user_data)
+        if intent is not None:
+            with self._lock:
+                self.num_hits += 1
+                self.intent_hits[intent.intent] = (
+                    self.intent_hits.get(intent.intent, 0) + 1
+                )
+
+            return intent
+
+        start = time.monotonic()
+        intent = fallback(text)
+        latency = time.monotonic() - start
+
+        with self._lock:
+            self.num_misses += 1
+            if self.remote_latency is None:
+                self.remote_latency = latency
+            else:
+                self.remote_latency += LATENCY_SMOOTHING * (
+                    latency - self.remote_latency
+                )
+
+        return intent
+
+    def stats(self):
+        """Get the hit rate statistics
+
+        Returns:
+            dict: the statistics, the saved latency is estimated from the
+                average Dialogflow latency
+        """
+        with self._lock:
+            total = self.num_hits + self.num_misses
+            return {
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits / total if total else 0.0,
+                "intent_hits": dict(self.intent_hits),
+                "remote_latency": self.remote_latency,
+                "latency_saved": self.num_hits * (self.remote_latency or 0.0),
+            }
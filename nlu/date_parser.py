@@ -0,0 +1,220 @@
+import re
+
+import arrow
+
+import consts
+
+MONTHS = {
+    "jan": 1,
+    "january": 1,
+    "feb": 2,
+    "february": 2,
+    "mar": 3,
+    "march": 3,
+    "apr": 4,
+    "april": 4,
+    "may": 5,
+    "jun": 6,
+    "june": 6,
+    "jul": 7,
+    "july": 7,
+    "aug": 8,
+    "august": 8,
+    "sep": 9,
+    "sept": 9,
+    "september": 9,
+    "oct": 10,
+    "october": 10,
+    "nov": 11,
+    "november": 11,
+    "dec": 12,
+    "december": 12,
+}
+WEEKDAYS = {
+    "mon": 0,
+    "monday": 0,
+    "tue": 1,
+    "tues": 1,
+    "tuesday": 1,
+    "wed": 2,
+    "wednesday": 2,
+    "thu": 3,
+    "thur": 3,
+    "thurs": 3,
+    "thursday": 3,
+    "fri": 4,
+    "friday": 4,
+    "sat": 5,
+    "saturday": 5,
+    "sun": 6,
+    "sunday": 6,
+}
+RELATIVE_DAYS = {
+    "today": 0,
+    "tonight": 0,
+    "tomorrow": 1,
+    "tmr": 1,
+    "tmrw": 1,
+    "day after tomorrow": 2,
+}
+NUMBERS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+
+# Filler words that don't change the meaning of a date
+FILLER_RE = re.compile(r"^(?:(?:its|it is|due|by|on|the|at|before)\s+)+")
+MONTH_RE = "|".join(sorted(MONTHS, key=len, reverse=True))
+DAY_MONTH_RE = re.compile(
+    rf"^(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?({MONTH_RE})(?:\s+(\d{{4}}))?$"
+)
+MONTH_DAY_RE = re.compile(
+    rf"^({MONTH_RE})\s+(\d{{1,2}})(?:st|nd|rd|th)?(?:\s+(\d{{4}}))?$"
+)
+NUMERIC_RE = re.compile(r"^(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{2}|\d{4}))?$")
+ISO_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+WEEKDAY_RE = re.compile(
+    rf"^(?:(this|next|coming|this coming)\s+)?({'|'.join(WEEKDAYS)})$"
+)
+IN_RE = re.compile(
+    rf"^in\s+(\d+|{'|'.join(NUMBERS)})\s+(day|days|week|weeks|month|months)$"
+)
+
+
+def parse_date(text, now=None):
+    """Parse common natural language date expressions
+
+    Dates are interpreted in consts.TIMEZONE with the day before the month,
+    dates without a year that have passed are moved to the next year.
+
+    Args:
+        text (str): the text to parse, e.g. "next friday", "25 Oct", "in 3 days"
+        now (Arrow, optional): the current datetime. Defaults to None.
+
+    Returns:
+        Arrow: the date at midday local time like Dialogflow dates, None if the
+            text couldn't be parsed
+    """
+    if now is None:
+        now = arrow.utcnow()
+
+    today = now.to(consts.TIMEZONE).floor("day")
+    text = FILLER_RE.sub("", normalise(text))
+    date = None
+
+    if text in RELATIVE_DAYS:
+        date = today.shift(days=RELATIVE_DAYS[text])
+    elif WEEKDAY_RE.match(text):
+        date = parse_weekday(WEEKDAY_RE.match(text), today)
+    elif IN_RE.match(text):
+        date = parse_in(IN_RE.match(text), today)
+    elif DAY_MONTH_RE.match(text):
+        day, month, year = DAY_MONTH_RE.match(text).groups()
+        date = get_date(today, year, MONTHS[month], day)
+    elif MONTH_DAY_RE.match(text):
+        month, day, year = MONTH_DAY_RE.match(text).groups()
+        date = get_date(today, year, MONTHS[month], day)
+    elif NUMERIC_RE.match(text):
+        day, month, year = NUMERIC_RE.match(text).groups()
+        if year is not None and len(year) == 2:
+            year = f"20{year}"
+
+        date = get_date(today, year, month, day)
+    elif ISO_RE.match(text):
+        year, month, day = ISO_RE.match(text).groups()
+        date = get_date(today, year, month, day)
+
+    if date is not None:
+        date = date.replace(hour=12)
+
+    return date
+
+
+def normalise(text):
+    """Normalise the text while keeping date separators
+
+    Args:
+        text (str): the text
+
+    Returns:
+        str: the lower case text without punctuation and extra whitespaces
+    """
+    text = re.sub(r"[^\w\s/.-]", "", text.lower())
+    return " ".join(text.strip(" .").split())
+
+
+def parse_weekday(match, today):
+    """Get the date of a weekday, "next" refers to the weekday of next week and
+    a weekday without "this" is never today
+
+    Args:
+        match (Match): the WEEKDAY_RE match
+        today (Arrow): the start of today
+
+    Returns:
+        Arrow: the date
+    """
+    modifier, weekday = match.groups()
+    weekday = WEEKDAYS[weekday]
+
+    if modifier == "next":
+        start_of_next_week = today.shift(days=7 - today.weekday())
+        return start_of_next_week.shift(days=weekday)
+
+    # Only "this friday" on a Friday is today, "friday" is a week away
+    days = (weekday - today.weekday()) % 7
+    if days == 0 and modifier != "this":
+        days = 7
+
+    return today.shift(days=days)
+
+
+def parse_in(match, today):
+    """Get the date of an "in N days/weeks/months" expression
+
+    Args:
+        match (Match): the IN_RE match
+        today (Arrow): the start of today
+
+    Returns:
+        Arrow: the date, None if it is out of the supported range
+    """
+    amount, unit = match.groups()
+    amount = NUMBERS[amount] if amount in NUMBERS else int(amount)
+    unit = unit if unit.endswith("s") else f"{unit}s"
+
+    try:
+        return today.shift(**{unit: amount})
+    except (OverflowError, ValueError):
+        return None
+
+
+def get_date(today, year, month, day):
+    """Build a local date, inferring the year if not given
+
+    Args:
+        today (Arrow): the start of today
+        year (str): the year, can be None
+        month (str or int): the month
+        day (str or int): the day
+
+    Returns:
+        Arrow: the date, None if the date is invalid
+    """
+    try:
+        if year is not None:
+            return today.replace(year=int(year), month=int(month), day=int(day))
+
+        month, day = int(month), int(day)
+    except ValueError:
+        return None
+
+    # The next occurrence of the date, 29 February can be up to 8 years away
+    # around century years that aren't leap years
+    for year in range(today.year, today.year + 9):
+        try:
+            date = today.replace(year=year, month=month, day=day)
+        except ValueError:
+            continue
+
+        if date >= today:
+            return date
+
+    return None
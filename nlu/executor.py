@@ -0,0 +1,293 @@
+import collections
+import logging
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from google.api_core import exceptions
+
+LOGGER = logging.getLogger(__name__)
+
+# Errors worth retrying as the next attempt may well succeed
+TRANSIENT_ERRORS = (
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+)
+
+# Errors caused by the request itself, the service is working
+REQUEST_ERRORS = (exceptions.InvalidArgument, exceptions.NotFound)
+
+# The number of latencies kept for the percentiles
+LATENCY_SAMPLES = 1000
+
+
+class CircuitBreaker:
+    """Stop calling an unhealthy service until it has had time to recover
+
+    The circuit opens after a number of consecutive failures, calls are then
+    refused until the reset timeout has passed, after which a single trial
+    call is let through to decide whether to close the circuit again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """
+        Args:
+            failure_threshold (int, optional): the consecutive failures that open
+                the circuit. Defaults to 5.
+            reset_timeout (float, optional): the seconds to wait before a trial
+                call. Defaults to 30.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.num_failures = 0
+        self.num_opened = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check if a call is allowed
+
+        Returns:
+            bool: whether the call is allowed
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.num_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.num_failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.num_failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN:
+                    self.num_opened += 1
+
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class NLUExecutor:
+    """Run NLU calls in a bounded thread pool
+
+    Each call has a deadline that covers its time in the queue and all of its
+    attempts, transient errors are retried with jittered exponential backoff.
+    The fallback is returned instead when the deadline passes, the call fails,
+    the queue is full or the circuit breaker is open, so a slow or unavailable
+    NLU service never holds up the caller for longer than the deadline. Errors
+    caused by the request itself don't count against the circuit breaker.
+    """
+
+    def __init__(
+        self,
+        workers=8,
+        max_pending=32,
+        deadline=5.0,
+        retries=2,
+        backoff=0.2,
+        breaker=None,
+    ):
+        """
+        Args:
+            workers (int, optional): the number of worker threads. Defaults to 8.
+            max_pending (int, optional): the maximum number of queued and running
+                calls. Defaults to 32.
+            deadline (float, optional): the seconds a call may take. Defaults to 5.
+            retries (int, optional): the retries on transient errors. Defaults to 2.
+            backoff (float, optional): the base backoff in seconds, doubled on
+                each retry. Defaults to 0.2.
+            breaker (CircuitBreaker, optional): the circuit breaker. Defaults to
+                None, which creates one with the default settings.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.num_calls = 0
+        self.num_retries = 0
+        self.num_timeouts = 0
+        self.num_failed = 0
+        self.num_rejected = 0
+        self.num_short_circuited = 0
+        self.num_pending = 0
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args, fallback, **kwargs):
+        """Call the function with a deadline, falling back if it can't be met
+
+        Args:
+            fn (callable): the NLU function, it is passed the remaining seconds
+                of the deadline as the timeout keyword argument
+            *args: the function arguments
+            fallback (callable): called without arguments for the result to use
+                when the call doesn't succeed in time
+            **kwargs: the function keyword arguments
+
+        Returns:
+            the function result, or the fallback result
+        """
+        start = time.monotonic()
+        deadline = start + self.deadline
+        is_cancelled = threading.Event()
+
+        # The limit is checked and the slot taken at once, so concurrent callers
+        # can't exceed it
+        with self._lock:
+            if self.num_pending >= self.max_pending:
+                self.num_rejected += 1
+                future = None
+            elif not self.breaker.allow():
+                self.num_short_circuited += 1
+                future = None
+            else:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="nlu"
+                    )
+
+                self.num_calls += 1
+                self.num_pending += 1
+                future = self._executor.submit(
+                    self._attempt, fn, args, kwargs, deadline, is_cancelled
+                )
+
+        if future is None:
+            return fallback()
+
+        future.add_done_callback(self._on_done)
+
+        try:
+            result = future.result(timeout=self.deadline)
+        except TimeoutError:
+            # Stop any further retries of the abandoned call
+            is_cancelled.set()
+            LOGGER.warning("NLU call timed out after %ss", self.deadline)
+            self.breaker.record_failure()
+            with self._lock:
+                self.num_timeouts += 1
+
+            return fallback()
+        except REQUEST_ERRORS:
+            # The service did answer, a bad request of one user mustn't open the
+            # circuit for everyone
+            LOGGER.exception("NLU call failed")
+            self.breaker.record_success()
+            with self._lock:
+                self.num_failed += 1
+
+            return fallback()
+        except Exception:
+            LOGGER.exception("NLU call failed")
+            self.breaker.record_failure()
+            with self._lock:
+                self.num_failed += 1
+
+            return fallback()
+
+        self.breaker.record_success()
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+
+        return result
+
+    def shutdown(self):
+        """Stop the worker threads without waiting for running calls"""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        """Get the queue and latency statistics
+
+        Returns:
+            dict: the statistics, latencies are in seconds
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "calls": self.num_calls,
+                "pending": self.num_pending,
+                "queue_depth": max(self.num_pending - self.workers, 0),
+                "retries": self.num_retries,
+                "timeouts": self.num_timeouts,
+                "failed": self.num_failed,
+                "rejected": self.num_rejected,
+                "short_circuited": self.num_short_circuited,
+                "circuit": self.breaker.state,
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+            }
+
+    def _attempt(self, fn, args, kwargs, deadline, is_cancelled):
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or is_cancelled.is_set():
+                raise TimeoutError()
+
+            try:
+                return fn(*args, timeout=remaining, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+
+                LOGGER.info("Retrying NLU call after transient error: %s", e)
+                with self._lock:
+                    self.num_retries += 1
+
+            # Full jitter so retries from many threads don't line up
+            delay = random.uniform(0, self.backoff * 2**attempt)
+            is_cancelled.wait(min(delay, max(deadline - time.monotonic(), 0)))
+            attempt += 1
+
+    def _on_done(self, future):
+        with self._lock:
+            self.num_pending -= 1
+
+
+def percentile(values, fraction):
+    """Get the percentile of the sorted values
+
+    Args:
+        values (list): the sorted values
+        fraction (float): the percentile between 0 and 1
+
+    Returns:
+        float: the percentile, None if there are no values
+    """
+    if not values:
+        return None
+
+    return values[min(int(len(values) * fraction), len(values) - 1)]
@@ -0,0 +1,64 @@
+import arrow
+
+
+class IntentResult:
+    def __init__(
+        self,
+        intent,
+        params,
+        all_params_present,
+        fulfill_text,
+        is_mentioned,
+        query_text=None,
+    ):
+        self.intent = intent
+        self.params = params
+        self.all_params_present = all_params_present
+        self.fulfill_text = fulfill_text
+        self.is_mentioned = is_mentioned
+        self.query_text = query_text
+
+    def to_dict(self):
+        """Convert the intent result into a JSON serialisable dict
+
+        Returns:
+            dict: the intent result, datetimes are in ISO 8601 format
+        """
+        params = None
+        if self.params is not None:
+            params = {
+                key: val.isoformat() if isinstance(val, arrow.Arrow) else val
+                for key, val in self.params.items()
+            }
+
+        return {
+            "intent": self.intent,
+            "params": params,
+            "all_params_present": self.all_params_present,
+            "fulfill_text": self.fulfill_text,
+            "is_mentioned": self.is_mentioned,
+            "query_text": self.query_text,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create an intent result from the dict created by to_dict
+
+        Args:
+            data (dict): the intent result dict
+
+        Returns:
+            IntentResult: the intent result
+        """
+        params = data["params"]
+        if params is not None and params.get("datetime") is not None:
+            params = dict(params, datetime=arrow.get(params["datetime"]))
+
+        return cls(
+            data["intent"],
+            params,
+            data["all_params_present"],
+            data["fulfill_text"],
+            data["is_mentioned"],
+            data.get("query_text"),
+        )
@@ -0,0 +1,87 @@
+import functools
+import pickle
+import threading
+
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from db import database
+
+# The pickled user data of a user without a conversation in progress
+EMPTY_USER_DATA = pickle.dumps({})
+
+
+class DatabasePersistence(BasePersistence):
+    """Persistence that keeps the user data of conversations in the database,
+    so a conversation started on one shard continues on any other
+
+    Updates are routed to shards by chat, while the multi-step flows are kept
+    per user, such as creating a poll for a group in the private chat. The
+    user data is loaded from the database before each update of the user and
+    stored within its unit of work, so it is rolled back with the rest of a
+    failed update, and is only written when it has changed. Chat and bot data
+    stay in the memory of each shard.
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_user_data=True, store_chat_data=False, store_bot_data=False
+        )
+        # The pickled user data in the database as last read or committed
+        self._stored = {}
+        self._lock = threading.Lock()
+
+    # User data never holds the bot, and copying the database objects it holds
+    # attribute by attribute would change their instance state
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def get_user_data(self):
+        # Loaded for each user by refresh_user_data when their update arrives
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def refresh_user_data(self, user_id, user_data):
+        # Always reloaded, the changes of a failed update were rolled back in
+        # the database but not in memory
+        data = database.get_user_data(user_id) or EMPTY_USER_DATA
+        with self._lock:
+            self._stored[user_id] = data
+
+        user_data.clear()
+        user_data.update(pickle.loads(data))
+
+    def update_user_data(self, user_id, data):
+        data = pickle.dumps(data) if data else EMPTY_USER_DATA
+        with self._lock:
+            if self._stored.get(user_id) == data:
+                return
+
+        database.set_user_data(user_id, None if data == EMPTY_USER_DATA else data)
+        database.after_commit(functools.partial(self._set_stored, user_id, data))
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def _set_stored(self, user_id, data):
+        with self._lock:
+            self._stored[user_id] = data
@@ -0,0 +1,162 @@
+import heapq
+import logging
+import threading
+
+import arrow
+
+LOGGER = logging.getLogger(__name__)
+
+
+class NotificationScheduler:
+    """In-memory scheduler that fires notifications at their due time
+
+    Pending notifications are kept in a min-heap keyed by their due time, a
+    background thread sleeps until the earliest one is due and then hands the
+    due notification IDs to the send callback. The heap is loaded once at
+    startup and kept in sync through `notis_added` and `notis_removed`, which
+    the database calls whenever the notifications table changes. Only the
+    notifications of chats accepted by the chat filter are scheduled, so each
+    shard only sends the notifications of its own chats.
+    """
+
+    def __init__(self, send_callback, chat_filter=None):
+        """
+        Args:
+            send_callback (callable): called with the list of due notification IDs
+            chat_filter (callable, optional): called with a chat ID and returns
+                whether to schedule notifications of the chat. Defaults to None.
+        """
+        self.send_callback = send_callback
+        self.chat_filter = chat_filter
+        self._heap = []
+        self._due_times = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def load(self, notis):
+        """Replace the scheduled notifications
+
+        Args:
+            notis (list): list of notifications
+        """
+        with self._cond:
+            self._due_times = {
+                noti.noti_id: arrow.get(noti.datetime).float_timestamp
+                for noti in notis
+                if self._is_included(noti.chat_id)
+            }
+            self._heap = [(due, noti_id) for noti_id, due in self._due_times.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+        LOGGER.info("Loaded %d pending notifications", len(self._heap))
+
+    def notis_added(self, notis):
+        """Schedule newly created notifications
+
+        Args:
+            notis (list): list of (notification ID, due datetime, chat ID) tuples
+        """
+        with self._cond:
+            for noti_id, datetime, chat_id in notis:
+                if not self._is_included(chat_id):
+                    continue
+
+                due = arrow.get(datetime).float_timestamp
+                self._due_times[noti_id] = due
+                heapq.heappush(self._heap, (due, noti_id))
+
+            self._cond.notify()
+
+    def notis_removed(self, noti_ids):
+        """Unschedule deleted notifications
+
+        Entries are removed lazily, they are skipped when they reach the top
+        of the heap.
+
+        Args:
+            noti_ids (list): list of notification IDs
+        """
+        with self._cond:
+            for noti_id in noti_ids:
+                self._due_times.pop(noti_id, None)
+
+            self._cond.notify()
+
+    def start(self):
+        """Start the scheduler thread"""
+        with self._cond:
+            if self._running:
+                return
+
+            self._running = True
+
+        self._thread = threading.Thread(
+            target=self._run, name="NotificationScheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _is_included(self, chat_id):
+        return self.chat_filter is None or self.chat_filter(chat_id)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._due_times)
+
+    def _pop_due(self):
+        """Wait until notifications are due and pop them off the heap
+
+        Returns:
+            list: the due notification IDs, empty if the scheduler has stopped
+        """
+        with self._cond:
+            while self._running:
+                # Discard entries that were removed or rescheduled
+                while self._heap and self._due_times.get(self._heap[0][1]) != (
+                    self._heap[0][0]
+                ):
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                delay = self._heap[0][0] - arrow.utcnow().float_timestamp
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                now = arrow.utcnow().float_timestamp
+                noti_ids = []
+                while self._heap and self._heap[0][0] <= now:
+                    due, noti_id = heapq.heappop(self._heap)
+                    if self._due_times.get(noti_id) == due:
+                        del self._due_times[noti_id]
+                        noti_ids.append(noti_id)
+
+                if noti_ids:
+                    return noti_ids
+
+        return []
+
+    def _run(self):
+        while True:
+            noti_ids = self._pop_due()
+            if not noti_ids:
+                break
+
+            try:
+                self.send_callback(noti_ids)
+            except Exception:
+                LOGGER.exception("Failed to send notifications %s", noti_ids)
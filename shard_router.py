@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from http import HTTPStatus
+
+from dotenv import load_dotenv
+from telegram import Bot
+
+from sharding import get_routing_id, get_shard
+from webhook import SECRET_TOKEN_HEADER, WebhookServer
+
+LOGGER = logging.getLogger(__name__)
+
+FORWARD_TIMEOUT = 10
+
+
+class ShardRouter(WebhookServer):
+    """Webhook server that forwards each update to the bot process owning its
+    chat
+
+    The router receives the updates from Telegram and validates them like the
+    bot webhook, then posts the unchanged body to the webhook of the owning
+    shard with the same secret token. A refusal by the shard is passed back to
+    Telegram so it delivers the update again later. Updates that go to every
+    shard aren't retried, as the shards that accepted them would process them
+    twice.
+    """
+
+    def __init__(
+        self, shard_urls, secret_token, listen="127.0.0.1", port=8443, path="/"
+    ):
+        """
+        Args:
+            shard_urls (list): the webhook URLs of the shards, by shard index
+            secret_token (str): the secret token of Telegram and the shards
+            listen (str, optional): the address to listen on.
+                Defaults to "127.0.0.1".
+            port (int, optional): the port to listen on. Defaults to 8443.
+            path (str, optional): the webhook URL path. Defaults to "/".
+        """
+        super().__init__(None, None, secret_token, listen=listen, port=port, path=path)
+        self.shard_urls = shard_urls
+        self._forwarded = [0] * len(shard_urls)
+        self._forward_lock = threading.Lock()
+
+    def receive(self, body):
+        """Forward a validated update to its shard
+
+        Args:
+            body (bytes): the request body
+
+        Returns:
+            HTTPStatus: the response status
+        """
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST
+
+        if not isinstance(update, dict):
+            return HTTPStatus.BAD_REQUEST
+
+        routing_id = get_routing_id(update)
+        if routing_id is not None:
+            return self.forward(get_shard(routing_id, len(self.shard_urls)), body)
+
+        for index in range(len(self.shard_urls)):
+            status = self.forward(index, body)
+            if status != HTTPStatus.OK:
+                LOGGER.warning(
+                    "Shard %d refused broadcast update %s with %d",
+                    index,
+                    update.get("update_id"),
+                    status,
+                )
+
+        return HTTPStatus.OK
+
+    def forward(self, index, body):
+        """Post an update to the webhook of a shard
+
+        Args:
+            index (int): the shard index
+            body (bytes): the update JSON
+
+        Returns:
+            HTTPStatus: the status returned by the shard, 503 if it couldn't be
+                reached
+        """
+        request = urllib.request.Request(
+            self.shard_urls[index],
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                SECRET_TOKEN_HEADER: self.secret_token,
+            },
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT) as response:
+                status = HTTPStatus(response.status)
+        except urllib.error.HTTPError as e:
+            status = HTTPStatus(e.code)
+        except OSError:
+            LOGGER.exception("Failed to forward update to shard %d", index)
+            status = HTTPStatus.SERVICE_UNAVAILABLE
+
+        if status == HTTPStatus.OK:
+            with self._forward_lock:
+                self._forwarded[index] += 1
+
+        return status
+
+    def stats(self):
+        """Get the request statistics
+
+        Returns:
+            dict: the webhook statistics and the number of updates forwarded to
+                each shard
+        """
+        stats = super().stats()
+        with self._forward_lock:
+            stats["forwarded"] = list(self._forwarded)
+
+        return stats
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    shard_urls = [
+        x.strip() for x in os.getenv("SHARD_URLS", "").split(",") if x.strip()
+    ]
+    if not webhook_url or not secret_token or not shard_urls:
+        raise SystemExit("WEBHOOK_URL, WEBHOOK_SECRET and SHARD_URLS must be set")
+
+    # Shards drop the updates of chats they don't own, so a router with a
+    # different number of shards would lose updates without any error
+    shard_count = int(os.getenv("SHARD_COUNT", 1))
+    if len(shard_urls) != shard_count:
+        raise SystemExit(
+            f"SHARD_URLS has {len(shard_urls)} URLs but SHARD_COUNT is {shard_count}"
+        )
+
+    router = ShardRouter(
+        shard_urls,
+        secret_token,
+        listen=os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+        port=int(os.getenv("WEBHOOK_PORT", 8443)),
+        path=urllib.parse.urlparse(webhook_url).path,
+    )
+    bot = Bot(
+        os.getenv("TELEGRAM_TOKEN"), base_url=os.getenv("TELEGRAM_API_URL") or None
+    )
+    bot.set_webhook(webhook_url, secret_token=secret_token)
+    LOGGER.info("Routing updates on port %d to %d shards", router.port, len(shard_urls))
+
+    try:
+        router.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.shutdown()
+        LOGGER.info("Router stats: %s", router.stats())
+
+
+if __name__ == "__main__":
+    main()
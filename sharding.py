@@ -0,0 +1,94 @@
+# Updates without a chat whose owner only the bot data of a shard knows, such as
+# the chat a poll was forwarded to, are sent to every shard
+BROADCAST_UPDATES = {"poll", "poll_answer"}
+
+
+def get_shard(chat_id, num_shards):
+    """Get the shard that owns a chat
+
+    Args:
+        chat_id (int): the chat ID
+        num_shards (int): the number of shards
+
+    Returns:
+        int: the shard index
+    """
+    return abs(chat_id) % num_shards
+
+
+class ShardConfig:
+    """The subset of chats a bot process owns
+
+    Chats are assigned to shards by their ID, so every process and the front
+    router agree on the owner of a chat without sharing any state. A single
+    shard owns every chat.
+
+    Updates are routed by chat while conversations are kept per user, so the
+    user data of sharded processes is stored in the shared database, and a
+    conversation that moves to another chat, such as creating a poll for a
+    group in the private chat, continues on the shard owning that chat.
+    """
+
+    def __init__(self, index=0, count=1):
+        """
+        Args:
+            index (int, optional): the shard index of this process. Defaults to 0.
+            count (int, optional): the number of shards. Defaults to 1.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+
+        self.index = index
+        self.count = count
+
+    @property
+    def is_sharded(self):
+        return self.count > 1
+
+    def owns(self, chat_id):
+        """Check if this shard owns the chat
+
+        Args:
+            chat_id (int): the chat ID
+
+        Returns:
+            bool: whether the chat is handled by this shard
+        """
+        return get_shard(chat_id, self.count) == self.index
+
+    def __repr__(self):
+        return f"ShardConfig({self.index}, {self.count})"
+
+
+def get_routing_id(update):
+    """Get the ID an update is routed to its shard by from its JSON
+
+    The raw update is inspected instead of parsing it into an Update, so the
+    router stays cheap.
+
+    Args:
+        update (dict): the update JSON
+
+    Returns:
+        int: the chat ID, or the user ID for updates without a chat, None for
+            updates that go to every shard
+    """
+    for key, value in update.items():
+        if key in BROADCAST_UPDATES:
+            return None
+
+        if not isinstance(value, dict):
+            continue
+
+        chat = value.get("chat")
+        if chat is None and isinstance(value.get("message"), dict):
+            chat = value["message"].get("chat")
+
+        if chat is not None:
+            return chat["id"]
+
+        user = value.get("from") or value.get("user")
+        if user is not None:
+            return user["id"]
+
+    return None
@@ -0,0 +1,11 @@
+from .transcode import (  # noqa
+    LINEAR16,
+    OGG_OPUS,
+    VoiceAudio,
+    prepare_voice,
+    transcode_voice,
+)
+from .cache import VoiceRecognitionCache, hash_audio, voice_cache  # noqa
+from .stats import VoiceStats  # noqa
+from .wake import WakeCheck, check_wake_phrase  # noqa
+from .workers import VoiceResult, VoiceWorkerPool, recognise_voice  # noqa
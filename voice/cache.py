@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import arrow
+
+import consts
+from api_service import get_intent_or_fallback
+from db import database
+from models import VoiceRecognitions
+from nlu import IntentResult
+
+CACHE_SIZE = 1000
+# Seconds to reuse a recognition for, defaults to a week
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# Intents that only make sense in the current Dialogflow conversation
+FOLLOWUP_INTENTS = {consts.MEETING_REMINDER, consts.MEETING_NO_REMIDNER}
+
+
+def hash_audio(ogg_bytes):
+    """Hash the content of a voice message
+
+    Args:
+        ogg_bytes (bytes): the voice message in OGG/Opus format
+
+    Returns:
+        str: the SHA-256 hex digest
+    """
+    return hashlib.sha256(ogg_bytes).hexdigest()
+
+
+class VoiceRecognitionCache:
+    """Cache of recognised voice messages
+
+    Recognitions are kept in memory and persisted in the database, keyed by
+    the Telegram file_unique_id so forwarded and re-sent voice messages skip
+    the download, and by the audio hash so identical audio skips transcoding
+    and recognition. Intents with date parameters or that follow up on the
+    conversation are recognised again from the stored query text.
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=None):
+        """
+        Args:
+            size (int, optional): the number of recognitions kept in memory.
+                Defaults to 1000.
+            ttl (int, optional): the seconds to reuse a recognition for.
+                Defaults to VOICE_CACHE_TTL or a week.
+        """
+        self.size = size
+        self.ttl = (
+            ttl if ttl is not None else int(os.getenv("VOICE_CACHE_TTL", CACHE_TTL))
+        )
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_unique_id=None, audio_hash=None):
+        """Get a recognition by its file or audio content
+
+        Args:
+            file_unique_id (str, optional): the Telegram file unique ID.
+                Defaults to None.
+            audio_hash (str, optional): the hash of the voice message audio.
+                Defaults to None.
+
+        Returns:
+            VoiceRecognitions: the recognition, None if not cached
+        """
+        now = time.monotonic()
+        key = file_unique_id or audio_hash
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.num_hits += 1
+                return entry[0]
+
+        with database.unit_of_work():
+            recognition = database.get_voice_recognition(
+                file_unique_id,
+                audio_hash,
+                after=arrow.utcnow().shift(seconds=-self.ttl),
+            )
+
+        with self._lock:
+            if recognition is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+                self._remember(key, recognition, now)
+
+        return recognition
+
+    def add(self, file_unique_id, audio_hash, intent):
+        """Store the recognised intent of a voice message
+
+        Args:
+            file_unique_id (str): the Telegram file unique ID
+            audio_hash (str): the hash of the voice message audio
+            intent (IntentResult): the recognised intent, it isn't stored if
+                nothing was recognised
+        """
+        if not intent.query_text or not intent.intent:
+            return
+
+        recognition = VoiceRecognitions(
+            file_unique_id=file_unique_id,
+            audio_hash=audio_hash,
+            query_text=intent.query_text,
+            intent=intent.intent,
+            fulfill_text=intent.fulfill_text,
+            is_mentioned=intent.is_mentioned,
+            needs_replay=intent.params is not None
+            or not intent.all_params_present
+            or intent.intent in FOLLOWUP_INTENTS,
+            datetime=arrow.utcnow(),
+        )
+        database.add_voice_recognition(recognition)
+
+        now = time.monotonic()
+        with self._lock:
+            self._remember(file_unique_id, recognition, now)
+            self._remember(audio_hash, recognition, now)
+
+    def resolve(self, recognition, session_id):
+        """Get the intent of a cached recognition
+
+        Args:
+            recognition (VoiceRecognitions): the recognition
+            session_id (str): the Dialogflow session ID
+
+        Returns:
+            IntentResult: the intent result
+        """
+        if recognition.needs_replay:
+            return get_intent_or_fallback(session_id, text=recognition.query_text)
+
+        return IntentResult(
+            recognition.intent,
+            None,
+            True,
+            recognition.fulfill_text,
+            recognition.is_mentioned,
+            recognition.query_text,
+        )
+
+    def stats(self):
+        """Get the hit rate statistics
+
+        Returns:
+            dict: the statistics
+        """
+        with self._lock:
+            total = self.num_hits + self.num_misses
+            return {
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits / total if total else 0.0,
+                "size": len(self._entries),
+            }
+
+    def _remember(self, key, recognition, now):
+        self._entries[key] = (recognition, now)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+voice_cache = VoiceRecognitionCache()
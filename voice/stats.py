@@ -0,0 +1,68 @@
+import threading
+
+
+class VoiceStats:
+    """Counters of voice messages by whether they were addressed to the bot,
+    and of the audio sent for recognition
+    """
+
+    def __init__(self):
+        self.num_addressed = 0
+        self.num_checked = 0
+        self.num_not_mentioned = 0
+        self.num_avoided = 0
+        self.num_preprocessed = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, is_addressed, is_mentioned=True, is_avoided=False):
+        """Record the outcome of a voice message
+
+        Args:
+            is_addressed (bool): whether it was addressed to the bot by metadata
+            is_mentioned (bool, optional): whether the recognised text starts
+                with the wake phrase. Defaults to True.
+            is_avoided (bool, optional): whether recognising the whole voice
+                message was avoided, by the wake phrase check or the voice
+                cache. Defaults to False.
+        """
+        with self._lock:
+            if is_avoided:
+                self.num_avoided += 1
+
+            if is_addressed:
+                self.num_addressed += 1
+            else:
+                self.num_checked += 1
+                if not is_mentioned:
+                    self.num_not_mentioned += 1
+
+    def record_audio(self, bytes_sent, bytes_saved):
+        """Record the audio sent for recognition
+
+        Args:
+            bytes_sent (int): the bytes of audio sent
+            bytes_saved (int): the bytes of audio saved by trimming
+        """
+        with self._lock:
+            self.num_preprocessed += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_saved += bytes_saved
+
+    def stats(self):
+        """Get the statistics
+
+        Returns:
+            dict: the statistics
+        """
+        with self._lock:
+            return {
+                "addressed": self.num_addressed,
+                "checked": self.num_checked,
+                "recognised_not_mentioned": self.num_not_mentioned,
+                "avoided": self.num_avoided,
+                "preprocessed": self.num_preprocessed,
+                "bytes_sent": self.bytes_sent,
+                "bytes_saved": self.bytes_saved,
+            }
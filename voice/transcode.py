@@ -0,0 +1,76 @@
+import collections
+import os
+
+import ffmpeg
+
+from voice.vad import trim_silence
+
+LINEAR16 = "LINEAR16"
+OGG_OPUS = "OGG_OPUS"
+
+SAMPLE_RATE = 16000
+# Telegram voice messages are Opus encoded at 48 kHz
+OPUS_SAMPLE_RATE = 48000
+# Only this many seconds of a voice message are sent for recognition
+MAX_VOICE_SECONDS = 30
+
+VoiceAudio = collections.namedtuple(
+    "VoiceAudio", ["content", "encoding", "sample_rate", "bytes_saved"]
+)
+
+
+def prepare_voice(ogg_bytes):
+    """Prepare a voice message for speech recognition
+
+    The OGG/Opus voice message is sent as is when VOICE_OGG_PASSTHROUGH=1,
+    otherwise it is transcoded in memory into 16 kHz mono LINEAR16, capped at
+    VOICE_MAX_SECONDS and trimmed of its leading and trailing silence.
+
+    Args:
+        ogg_bytes (bytes): the voice message in OGG/Opus format
+
+    Returns:
+        VoiceAudio: the audio content, its encoding, sample rate and the number
+            of bytes the trimming saved from the decoded audio
+    """
+    if os.getenv("VOICE_OGG_PASSTHROUGH") == "1":
+        return VoiceAudio(ogg_bytes, OGG_OPUS, OPUS_SAMPLE_RATE, 0)
+
+    max_seconds = float(os.getenv("VOICE_MAX_SECONDS", MAX_VOICE_SECONDS))
+    pcm = transcode_voice(ogg_bytes, duration=max_seconds)
+    content = trim_silence(pcm, SAMPLE_RATE)
+
+    return VoiceAudio(content, LINEAR16, SAMPLE_RATE, len(pcm) - len(content))
+
+
+def transcode_voice(ogg_bytes, sample_rate=SAMPLE_RATE, duration=None):
+    """Transcode a voice message into raw mono LINEAR16 audio, streaming it
+    through ffmpeg's stdin and stdout without touching the disk
+
+    Args:
+        ogg_bytes (bytes): the voice message in OGG/Opus format
+        sample_rate (int, optional): the output sample rate. Defaults to 16000.
+        duration (float, optional): only transcode this many seconds from the
+            start. Defaults to None.
+
+    Returns:
+        bytes: the 16-bit little endian PCM samples
+    """
+    kwargs = {}
+    if duration is not None:
+        kwargs["t"] = duration
+
+    pcm, _ = (
+        ffmpeg.input("pipe:0", format="ogg")
+        .output(
+            "pipe:1",
+            format="s16le",
+            acodec="pcm_s16le",
+            ac=1,
+            ar=sample_rate,
+            **kwargs,
+        )
+        .run(input=ogg_bytes, capture_stdout=True, capture_stderr=True)
+    )
+
+    return pcm
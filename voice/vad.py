@@ -0,0 +1,90 @@
+import math
+import operator
+import sys
+
+from array import array
+
+FRAME_MS = 30
+# RMS of 16-bit samples below which a frame is never considered speech
+MIN_SPEECH_RMS = 300
+# Frames this many times louder than the noise floor are considered speech
+NOISE_FLOOR_RATIO = 3
+# Silence kept around the speech when trimming
+PADDING_MS = 150
+
+
+def frame_energies(pcm, sample_rate, frame_ms=FRAME_MS):
+    """Get the RMS energy of each frame of the audio
+
+    Args:
+        pcm (bytes): 16-bit little endian mono PCM samples
+        sample_rate (int): the sample rate
+        frame_ms (int, optional): the frame length in ms. Defaults to 30.
+
+    Returns:
+        list: the RMS energy of each frame
+    """
+    samples = array("h")
+    samples.frombytes(pcm[: len(pcm) - len(pcm) % 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    frame_size = sample_rate * frame_ms // 1000
+    energies = []
+
+    for start in range(0, len(samples) - frame_size + 1, frame_size):
+        end = start + frame_size
+        frame = samples[start:end]
+        energies.append(math.sqrt(sum(map(operator.mul, frame, frame)) / frame_size))
+
+    return energies
+
+
+def speech_frames(energies):
+    """Classify each frame as speech or silence against the noise floor
+
+    Args:
+        energies (list): the RMS energy of each frame
+
+    Returns:
+        list: whether each frame is speech
+    """
+    if not energies:
+        return []
+
+    noise_floor = sorted(energies)[len(energies) // 10]
+    threshold = max(MIN_SPEECH_RMS, noise_floor * NOISE_FLOOR_RATIO)
+
+    return [x >= threshold for x in energies]
+
+
+def trim_silence(pcm, sample_rate, frame_ms=FRAME_MS, padding_ms=PADDING_MS):
+    """Trim the leading and trailing silence of the audio
+
+    Args:
+        pcm (bytes): 16-bit little endian mono PCM samples
+        sample_rate (int): the sample rate
+        frame_ms (int, optional): the frame length in ms. Defaults to 30.
+        padding_ms (int, optional): the silence in ms kept around the speech so
+            words aren't clipped. Defaults to 150.
+
+    Returns:
+        bytes: the trimmed PCM samples, the audio is returned as is if no speech
+            is found
+    """
+    is_speech = speech_frames(frame_energies(pcm, sample_rate, frame_ms))
+    if not any(is_speech):
+        return pcm
+
+    first = is_speech.index(True)
+    last = len(is_speech) - is_speech[::-1].index(True)
+    padding = math.ceil(padding_ms / frame_ms)
+
+    # Each sample is 2 bytes
+    frame_bytes = sample_rate * frame_ms // 1000 * 2
+    start = max(first - padding, 0) * frame_bytes
+    end = (last + padding) * frame_bytes
+    if last + padding >= len(is_speech):
+        end = len(pcm)
+
+    return pcm[start:end]
@@ -0,0 +1,55 @@
+import collections
+import os
+
+from api_service import get_intent_or_fallback
+from voice.transcode import LINEAR16, SAMPLE_RATE, transcode_voice
+from voice.vad import MIN_SPEECH_RMS, frame_energies, trim_silence
+
+# Seconds at the start of a voice message in which the wake phrase is expected
+WAKE_SECONDS = 3
+
+WakeCheck = collections.namedtuple("WakeCheck", ["is_mentioned", "bytes_sent"])
+
+
+def check_wake_phrase(ogg_bytes, session_id):
+    """Check if a voice message starts with the wake phrase from its first
+    seconds only
+
+    The first VOICE_WAKE_SECONDS are decoded, a window without any speech
+    can't start with "Hey Dojo" and isn't sent anywhere. Otherwise only the
+    window is recognised, in a session of its own so the partial query doesn't
+    take part in the Dialogflow conversation. The check is skipped with
+    VOICE_WAKE_SECONDS=0.
+
+    Args:
+        ogg_bytes (bytes): the voice message in OGG/Opus format
+        session_id (str): the Dialogflow session ID of the user
+
+    Returns:
+        WakeCheck: whether the wake phrase was heard and the audio bytes sent,
+            None if the voice message fits in the window or the check is off,
+            as recognising it whole costs the same
+    """
+    seconds = float(os.getenv("VOICE_WAKE_SECONDS", WAKE_SECONDS))
+    if seconds <= 0:
+        return None
+
+    # The noise floor of a window that is all speech is speech, so frames are
+    # compared with the fixed speech threshold only
+    pcm = transcode_voice(ogg_bytes, duration=seconds)
+    if max(frame_energies(pcm, SAMPLE_RATE), default=0) < MIN_SPEECH_RMS:
+        return WakeCheck(False, 0)
+
+    # Each sample is 2 bytes
+    if len(pcm) < int(seconds * SAMPLE_RATE) * 2:
+        return None
+
+    content = trim_silence(pcm, SAMPLE_RATE)
+    intent = get_intent_or_fallback(
+        f"{session_id}-wake",
+        input_audio=content,
+        audio_encoding=LINEAR16,
+        sample_rate=SAMPLE_RATE,
+    )
+
+    return WakeCheck(intent.is_mentioned, len(content))
@@ -0,0 +1,164 @@
+import collections
+import logging
+import multiprocessing
+import threading
+import urllib.request
+
+from concurrent.futures import ProcessPoolExecutor
+
+from api_service import get_intent_or_fallback
+from voice.cache import hash_audio, voice_cache
+from voice.transcode import prepare_voice
+from voice.wake import check_wake_phrase
+
+LOGGER = logging.getLogger(__name__)
+
+DOWNLOAD_TIMEOUT = 30
+
+VoiceResult = collections.namedtuple(
+    "VoiceResult",
+    ["intent", "bytes_sent", "bytes_saved", "audio_hash", "is_avoided"],
+)
+
+
+def recognise_voice(file_url, session_id, is_addressed=True):
+    """Download, transcode and recognise a voice message, this runs in a
+    worker process
+
+    Args:
+        file_url (str): the Telegram file download URL
+        session_id (str): the Dialogflow session ID
+        is_addressed (bool, optional): whether the voice message is addressed
+            to the bot by its metadata. Defaults to True.
+
+    Returns:
+        VoiceResult: the intent result from Dialogflow, None for an unaddressed
+            voice message that is known not to mention the bot, along with the
+            audio bytes sent and saved by the preprocessing, the audio hash and
+            whether recognising the whole voice message was avoided
+    """
+    with urllib.request.urlopen(file_url, timeout=DOWNLOAD_TIMEOUT) as response:
+        ogg_bytes = response.read()
+
+    # The same audio may have been uploaded again as a different file
+    audio_hash = hash_audio(ogg_bytes)
+    recognition = voice_cache.get(audio_hash=audio_hash)
+    if recognition is not None:
+        if not is_addressed and not recognition.is_mentioned:
+            return VoiceResult(None, 0, 0, audio_hash, True)
+
+        intent = voice_cache.resolve(recognition, session_id)
+        return VoiceResult(intent, 0, 0, audio_hash, not recognition.needs_replay)
+
+    wake_bytes_sent = 0
+    if not is_addressed:
+        wake = check_wake_phrase(ogg_bytes, session_id)
+        if wake is not None:
+            if not wake.is_mentioned:
+                return VoiceResult(None, wake.bytes_sent, 0, audio_hash, True)
+
+            wake_bytes_sent = wake.bytes_sent
+
+    audio = prepare_voice(ogg_bytes)
+    LOGGER.info(
+        "Sending %d bytes of voice audio, %d bytes saved",
+        len(audio.content),
+        audio.bytes_saved,
+    )
+    intent = get_intent_or_fallback(
+        session_id,
+        input_audio=audio.content,
+        audio_encoding=audio.encoding,
+        sample_rate=audio.sample_rate,
+    )
+
+    return VoiceResult(
+        intent,
+        len(audio.content) + wake_bytes_sent,
+        audio.bytes_saved,
+        audio_hash,
+        False,
+    )
+
+
+class VoiceWorkerPool:
+    """Pool of worker processes for voice messages
+
+    Voice jobs are run in separate processes so transcoding doesn't compete
+    with the dispatcher for the GIL. The number of submitted jobs that haven't
+    finished is bounded, further jobs are rejected until a slot frees up.
+    """
+
+    def __init__(self, workers=2, max_pending=16):
+        """
+        Args:
+            workers (int, optional): the number of worker processes. Defaults to 2.
+            max_pending (int, optional): the maximum number of queued and running
+                jobs. Defaults to 16.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.num_submitted = 0
+        self.num_rejected = 0
+        self.num_failed = 0
+        self.num_pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, callback):
+        """Submit a job to the worker processes
+
+        Args:
+            fn (callable): a module level function to run in a worker process
+            *args: the function arguments
+            callback (callable): called with the job result in the parent process,
+                or None if the job failed
+
+        Returns:
+            bool: whether the job was accepted, False if the queue is full
+        """
+        with self._lock:
+            if self.num_pending >= self.max_pending:
+                self.num_rejected += 1
+                return False
+
+            # Spawn fresh processes as forking after gRPC has started is unsafe
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+
+            self.num_submitted += 1
+            self.num_pending += 1
+            future = self._executor.submit(fn, *args)
+
+        future.add_done_callback(lambda x: self._on_done(x, callback))
+
+        return True
+
+    def shutdown(self):
+        """Wait for the running jobs and stop the worker processes"""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        # Finished jobs take the lock in their callbacks, wait outside of it
+        if executor is not None:
+            executor.shutdown()
+
+    def _on_done(self, future, callback):
+        result = None
+        try:
+            result = future.result()
+        except Exception:
+            LOGGER.exception("Voice job failed")
+            with self._lock:
+                self.num_failed += 1
+
+        with self._lock:
+            self.num_pending -= 1
+
+        try:
+            callback(result)
+        except Exception:
+            LOGGER.exception("Voice job callback failed")
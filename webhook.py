@@ -0,0 +1,159 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+LOGGER = logging.getLogger(__name__)
+
+# Header Telegram sends the secret token set with setWebhook in
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Updates are at most a few kilobytes, anything much larger isn't from Telegram
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    """HTTP server that receives updates from Telegram and puts them on the
+    update queue
+
+    Requests must be posted to the webhook path with the secret token that was
+    registered with setWebhook. The update queue is bounded, when it is full
+    the update is refused with 503 so Telegram delivers it again later instead
+    of the bot buffering without limit. Requests are handled on their own
+    threads, which only parse the update and queue it.
+    """
+
+    def __init__(
+        self, update_queue, bot, secret_token, listen="127.0.0.1", port=8443, path="/"
+    ):
+        """
+        Args:
+            update_queue (Queue): the dispatcher update queue
+            bot (Bot): the Telegram bot object
+            secret_token (str): the secret token Telegram sends with each update
+            listen (str, optional): the address to listen on.
+                Defaults to "127.0.0.1".
+            port (int, optional): the port to listen on. Defaults to 8443.
+            path (str, optional): the webhook URL path. Defaults to "/".
+        """
+        self.update_queue = update_queue
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path or "/"
+        self.num_received = 0
+        self.num_rejected = 0
+        self.num_dropped = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self._httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def serve_forever(self):
+        """Handle requests until the server is shut down"""
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop handling requests and close the socket"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def stats(self):
+        """Get the request statistics
+
+        Returns:
+            dict: the number of updates queued, requests rejected and updates
+                dropped because the queue was full
+        """
+        with self._lock:
+            return {
+                "received": self.num_received,
+                "rejected": self.num_rejected,
+                "dropped": self.num_dropped,
+            }
+
+    def handle_request(self, path, headers, body):
+        """Validate a webhook request and queue its update
+
+        Args:
+            path (str): the request path
+            headers (Message): the request headers
+            body (bytes): the request body
+
+        Returns:
+            HTTPStatus: the response status
+        """
+        # Compared as bytes, compare_digest raises for strings with non-ASCII
+        # characters, which anyone can send in the header
+        if path != self.path:
+            status = HTTPStatus.NOT_FOUND
+        elif not hmac.compare_digest(
+            headers.get(SECRET_TOKEN_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            status = HTTPStatus.FORBIDDEN
+        else:
+            status = self.receive(body)
+
+        with self._lock:
+            if status == HTTPStatus.OK:
+                self.num_received += 1
+            elif status == HTTPStatus.SERVICE_UNAVAILABLE:
+                self.num_dropped += 1
+            else:
+                self.num_rejected += 1
+
+        return status
+
+    def receive(self, body):
+        """Parse a validated update and put it on the update queue
+
+        Args:
+            body (bytes): the request body
+
+        Returns:
+            HTTPStatus: the response status
+        """
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError):
+            return HTTPStatus.BAD_REQUEST
+
+        if update is None:
+            return HTTPStatus.BAD_REQUEST
+
+        try:
+            self.update_queue.put_nowait(update)
+        except queue.Full:
+            LOGGER.warning("Update queue is full, refused update %s", update.update_id)
+            return HTTPStatus.SERVICE_UNAVAILABLE
+
+        return HTTPStatus.OK
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY_SIZE:
+                    self.close_connection = True
+                    status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                else:
+                    body = self.rfile.read(length)
+                    status = server.handle_request(self.path, self.headers, body)
+
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+        return WebhookHandler